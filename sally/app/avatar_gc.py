@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from logging_config import get_logger
+
+logger = get_logger("avatar_gc")
+
+# How often the sweeper runs
+AVATAR_GC_INTERVAL = float(os.getenv("AVATAR_GC_INTERVAL", "600"))
+# Unreferenced avatars are kept this long so recently served URLs keep working
+AVATAR_RETENTION_SECONDS = float(os.getenv("AVATAR_RETENTION_SECONDS", "86400"))
+# Avatars younger than this are never deleted, even under quota pressure;
+# this covers the gap between writing a new avatar and saving it in character state
+AVATAR_MIN_AGE_SECONDS = float(os.getenv("AVATAR_MIN_AGE_SECONDS", "300"))
+# Total size allowed across the avatar directories (0 disables the quota)
+AVATAR_DISK_QUOTA_MB = float(os.getenv("AVATAR_DISK_QUOTA_MB", "200"))
+
+
+class AvatarSweeper:
+    """Deletes avatars no character points at, by age and under a disk quota (LRU)"""
+
+    def __init__(self, directories: List[Tuple[str, str]], get_referenced: Callable[[], Set[str]]):
+        self.directories = directories
+        self.get_referenced = get_referenced
+        self._task: Optional[asyncio.Task] = None
+
+    def _scan(self) -> List[Dict[str, Any]]:
+        """List avatar files with their URL, size and last-use time"""
+        avatars = []
+        for directory_path, url_prefix in self.directories:
+            try:
+                entries = list(os.scandir(directory_path))
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning("Could not scan avatar directory %s: %s", directory_path, e)
+                continue
+            for entry in entries:
+                if not entry.name.endswith(".png") or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                avatars.append({
+                    "path": entry.path,
+                    "url": f"{url_prefix}/{entry.name}",
+                    "size": stat.st_size,
+                    "created": stat.st_mtime,
+                    # atime is only as good as the mount options allow; mtime is the floor
+                    "last_used": max(stat.st_atime, stat.st_mtime),
+                })
+        return avatars
+
+    def _delete(self, avatar: Dict[str, Any]) -> bool:
+        """Remove one avatar file, tolerating files that are already gone"""
+        try:
+            os.remove(avatar["path"])
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning("Could not delete avatar %s: %s", avatar["path"], e)
+            return False
+
+    def sweep(self, referenced: Optional[Set[str]] = None) -> Dict[str, Any]:
+        """Run one collection pass and return what it did"""
+        if referenced is None:
+            referenced = self.get_referenced()
+        now = time.time()
+        avatars = self._scan()
+        total_bytes = sum(avatar["size"] for avatar in avatars)
+
+        # Only unreferenced avatars past the minimum age are ever candidates
+        candidates = [avatar for avatar in avatars
+                      if avatar["url"] not in referenced and now - avatar["created"] >= AVATAR_MIN_AGE_SECONDS]
+        candidates.sort(key=lambda avatar: avatar["last_used"])
+
+        deleted = []
+        quota_bytes = AVATAR_DISK_QUOTA_MB * 1024 * 1024
+        for avatar in candidates:
+            expired = now - avatar["last_used"] >= AVATAR_RETENTION_SECONDS
+            over_quota = quota_bytes > 0 and total_bytes > quota_bytes
+            if not (expired or over_quota):
+                continue
+            if self._delete(avatar):
+                total_bytes -= avatar["size"]
+                deleted.append(avatar["url"])
+
+        stats = {
+            "scanned": len(avatars),
+            "deleted": len(deleted),
+            "remaining_bytes": total_bytes,
+            "over_quota": quota_bytes > 0 and total_bytes > quota_bytes,
+        }
+        if deleted:
+            logger.info("Avatar sweep deleted unreferenced avatars", extra=stats)
+        if stats["over_quota"]:
+            logger.warning("Avatar storage still over quota; remaining avatars are referenced or too new", extra=stats)
+        return stats
+
+    async def run(self):
+        """Sweep periodically until cancelled"""
+        while True:
+            await asyncio.sleep(AVATAR_GC_INTERVAL)
+            try:
+                # Snapshot references on the loop, do the file I/O off it
+                referenced = self.get_referenced()
+                await asyncio.to_thread(self.sweep, referenced)
+            except Exception as e:
+                logger.error("Avatar sweep failed: %s", e)
+
+    def start(self):
+        """Start the background sweep task"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Cancel the background sweep task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
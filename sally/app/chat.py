@@ -3,15 +3,68 @@ import os
 import asyncio
 import random
 import base64
+import re
+import weakref
+import time
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, AsyncIterator, Iterator, Callable
 from together import AsyncTogether
 from dotenv import load_dotenv
 import requests
 
-# Load environment variables from .env file
+# Load environment variables from .env file, before the app modules below read their settings
 load_dotenv()
 
+from logging_config import get_logger, request_id_var
+from memory_stream import iter_memory_entries, encode_cursor
+from memory_records import MemoryLog, MemoryEntry, Role, USER_TURN_PREFIX, CHARACTER_TURN_PREFIX
+from generation_budget import GenerationBudgetController
+from task_graph import TaskGraph
+from versioned_state import VersionedState
+from usage import UsageTracker, UsageThrottledError
+from storage import WriteBehindStore
+from event_bus import EventBus, MULTI_WORKER
+
+logger = get_logger("chat")
+
+# Model used for conversation and helper completions
+CHAT_MODEL = "deepseek-ai/DeepSeek-V3"
+IMAGE_MODEL = "black-forest-labs/FLUX.1-schnell-Free"
+
+# Session that maps onto the original top-level memory files
+DEFAULT_SESSION = "default"
+SESSION_ID_PATTERN = r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$"
+
+# Whether /chat waits a short random "typing" delay before answering
+SIMULATE_TYPING_DELAY = os.getenv("SIMULATE_TYPING_DELAY", "1") == "1"
+
+# Upper bound on batch turns processed at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Progress status shown as each /change task finishes
+TRANSFORMATION_STEP_STATUS = {
+    "personality": "Personality written...",
+    "visual": "Appearance designed...",
+    "image": "Avatar rendered...",
+    "character": "Memories created...",
+    "avatar": "Avatar saved...",
+}
+
+# Memory files and the role of their entries
+MEMORY_FILE_ROLES = {"user.json": Role.USER, "sally.json": Role.CHARACTER}
+
+# Chat history is sent in blocks of this many messages so the prompt prefix
+# only shifts once per block instead of on every turn
+HISTORY_WINDOW = max(1, int(os.getenv("HISTORY_WINDOW", "12")))
+
+# Avatar storage directories and the URL prefix each is served under, in order of preference
+AVATAR_DIRECTORIES = [
+    ("static/avatars", "/static/avatars"),  # Main directory
+    ("/tmp/sally_avatars", "/tmp_avatars")   # Fallback directory (mounted at /tmp_avatars)
+]
+
+CONSISTENCY_GUIDANCE = "IMPORTANT: Stay consistent with the conversation. Don't randomly change what you're doing or where you are. Build on what you've already said and keep the conversation flowing naturally. Focus on responding to what the user just said."
+
 class ChatHandler:
     def __init__(self):
         self.memory_dir = "memory"
@@ -26,6 +79,36 @@ class ChatHandler:
         # Character state tracking
         self.current_character = None
         
+        # Versions of the character and progress state, for conditional GETs and long-polling
+        self.character_state = VersionedState(self.get_current_character)
+        self.progress_state = VersionedState(self.get_progress)
+        
+        # Per-session locks so turns of one session never interleave
+        self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        
+        # Memory and character state writes are batched into journaled group commits
+        self.store = WriteBehindStore(shared=MULTI_WORKER)
+        self.store.compact = self._compact_document
+        
+        # Token and image usage per session, with budget enforcement
+        self.usage = UsageTracker(self.store)
+        
+        # Cross-worker event bus, attached in multi-worker mode
+        self.event_bus: Optional[EventBus] = None
+        
+        # Latest transformation progress, kept in memory for fast polling
+        self._progress: Optional[Dict[str, Any]] = None
+        
+        # Optional callback receiving (stage, seconds) for each chat pipeline stage
+        self.stage_observer: Optional[Callable[[str, float], None]] = None
+        
+        # Adapts reply token budgets to observed upstream latency
+        self.generation_budget = GenerationBudgetController(CHAT_MODEL)
+        
+        # Rendered static prompt segments, memoized per character personality
+        self._static_prompt_cache: Dict[str, Dict[str, str]] = {}
+        self._time_context_cache: Tuple[Optional[Tuple[str, str]], str] = (None, "")
+        
         # Initialize Together AI async client
         self.client = AsyncTogether(
             api_key=os.getenv("TOGETHER_API_KEY")
@@ -53,13 +136,13 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
         """Create memory directory and files if they don't exist"""
         # Try main memory directory first
         if self._try_initialize_directory(self.memory_dir):
-            print("✅ Using main memory directory")
+            logger.info("Using main memory directory", extra={"memory_dir": self.memory_dir})
             return
         
         # If main directory fails, try fallback
-        print("⚠️ Main memory directory failed, trying fallback...")
+        logger.warning("Main memory directory failed, trying fallback")
         if self._try_initialize_directory(self.fallback_memory_dir):
-            print("✅ Using fallback memory directory")
+            logger.info("Using fallback memory directory", extra={"memory_dir": self.fallback_memory_dir})
             # Update all file paths to use fallback directory
             self.memory_dir = self.fallback_memory_dir
             self.user_memory_file = os.path.join(self.memory_dir, "user.json")
@@ -69,7 +152,7 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
             return
         
         # If both fail, run with minimal memory (in-memory only)
-        print("⚠️ Both memory directories failed, running with minimal memory...")
+        logger.warning("Both memory directories failed, running with minimal memory")
         self._initialize_minimal_memory()
 
     def _try_initialize_directory(self, directory: str) -> bool:
@@ -77,7 +160,7 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
         try:
             # Create memory directory with proper permissions
             os.makedirs(directory, mode=0o777, exist_ok=True)
-            print(f"✅ Memory directory created/verified: {directory}")
+            logger.debug("Memory directory created/verified", extra={"memory_dir": directory})
             
             # Check if we have write permissions
             test_file = os.path.join(directory, "test_write.tmp")
@@ -85,20 +168,24 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
                 with open(test_file, 'w') as f:
                     f.write("test")
                 os.remove(test_file)
-                print(f"✅ Write permissions confirmed for {directory}")
+                logger.debug("Write permissions confirmed", extra={"memory_dir": directory})
             except PermissionError as pe:
-                print(f"❌ Permission error testing write access to {directory}: {pe}")
+                logger.error("Permission error testing write access to %s: %s", directory, pe)
                 return False
             
+            # Finish any group commit interrupted by a crash before reading state
+            self.store.open(directory)
+            self.usage.open(os.path.join(directory, "usage.json"))
+            
             # Initialize user memory
             user_memory_file = os.path.join(directory, "user.json")
             if not os.path.exists(user_memory_file):
                 try:
                     with open(user_memory_file, 'w') as f:
                         json.dump({}, f, indent=2)
-                    print(f"✅ Created user memory file: {user_memory_file}")
+                    logger.info("Created user memory file", extra={"path": user_memory_file})
                 except PermissionError as pe:
-                    print(f"❌ Failed to create user memory file: {pe}")
+                    logger.error("Failed to create user memory file: %s", pe)
                     return False
             
             # Initialize Sally's memory
@@ -111,23 +198,27 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
                     }
                     with open(sally_memory_file, 'w') as f:
                         json.dump(initial_sally_memory, f, indent=2)
-                    print(f"✅ Created Sally memory file: {sally_memory_file}")
+                    logger.info("Created Sally memory file", extra={"path": sally_memory_file})
                 except PermissionError as pe:
-                    print(f"❌ Failed to create Sally memory file: {pe}")
+                    logger.error("Failed to create Sally memory file: %s", pe)
                     return False
             
             # Load existing character state or create default
             self.load_character_state()
-            print(f"✅ Memory initialization completed successfully in {directory}")
+            progress_file = os.path.join(directory, "transformation_progress.json")
+            if os.path.exists(progress_file):
+                # As with the character: workers starting from the same file agree on its version
+                self.progress_state.bump(int(os.path.getmtime(progress_file) * 1000))
+            logger.info("Memory initialization completed", extra={"memory_dir": directory})
             return True
             
         except Exception as e:
-            print(f"❌ Memory initialization failed for {directory}: {e}")
+            logger.error("Memory initialization failed for %s: %s", directory, e)
             return False
 
     def _initialize_minimal_memory(self):
         """Initialize with minimal in-memory storage when file system access fails"""
-        print("🔧 Initializing minimal in-memory storage...")
+        logger.info("Initializing minimal in-memory storage")
         
         # Use in-memory storage for critical data
         self.current_character = {
@@ -138,15 +229,19 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
             "personality": self.base_personality
         }
         
-        print("✅ Minimal memory initialized - app will run with limited persistence")
+        self.character_state.bump()
+        logger.warning("Minimal memory initialized - app will run with limited persistence")
 
     def load_character_state(self):
         """Load character state from file"""
+        loaded_version = None
         try:
             if os.path.exists(self.character_state_file):
                 with open(self.character_state_file, 'r') as f:
                     self.current_character = json.load(f)
-                print(f"Loaded existing character: {self.current_character['name']}")
+                # Workers loading the same file give it the same version
+                loaded_version = int(os.path.getmtime(self.character_state_file) * 1000)
+                logger.info("Loaded existing character", extra={"character": self.current_character['name']})
             else:
                 # Create default Sally character
                 self.current_character = {
@@ -157,9 +252,9 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
                     "personality": self.base_personality
                 }
                 self.save_character_state()
-                print("Created default Sally character")
+                logger.info("Created default Sally character")
         except Exception as e:
-            print(f"Error loading character state: {e}")
+            logger.error("Error loading character state: %s", e)
             # Fallback to default Sally
             self.current_character = {
                 "name": "Sally",
@@ -168,18 +263,52 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
                 "created_at": datetime.now().isoformat() + "Z",
                 "personality": self.base_personality
             }
+        self.character_state.bump(loaded_version)
+
+    def attach_event_bus(self, event_bus: EventBus):
+        """Share character, progress and storage changes with other workers"""
+        self.event_bus = event_bus
+        event_bus.subscribe("character_state", self._apply_remote_character)
+        event_bus.subscribe("progress", self._apply_remote_progress)
+        event_bus.subscribe("documents_committed", lambda payload: self.store.invalidate(payload["paths"]))
+        self.store.on_commit = lambda paths: event_bus.publish("documents_committed", {"paths": paths})
+
+    def _apply_remote_character(self, payload: Dict[str, Any]):
+        """Adopt a character change made by another worker, under the version it gave it"""
+        if payload["version"] <= self.character_state.version:
+            # We already hold a newer character
+            return
+        character = payload["character"]
+        self.current_character = character
+        self.base_personality = character.get("personality", self.base_personality)
+        self.character_state.bump(payload["version"])
+        logger.info("Applied character change from another worker", extra={"character": character.get("name")})
+
+    def _apply_remote_progress(self, payload: Dict[str, Any]):
+        """Adopt a progress update made by another worker, under the version it gave it"""
+        if payload["version"] <= self.progress_state.version:
+            return
+        self._progress = payload["progress"]
+        self.progress_state.bump(payload["version"])
 
     def save_character_state(self):
-        """Save current character state to file"""
+        """Save current character state (persisted by the next group commit)"""
         try:
-            with open(self.character_state_file, 'w') as f:
-                json.dump(self.current_character, f, indent=2)
-            print(f"✅ Saved character state for {self.current_character['name']}")
-        except PermissionError as e:
-            print(f"⚠️ Could not save character state: {e}")
-            print("Character state will be kept in memory only")
+            self.store.replace(self.character_state_file, self.current_character)
+            self.character_state.bump()
+            if self.event_bus is not None:
+                self.event_bus.publish("character_state", {"version": self.character_state.version,
+                                                           "character": self.current_character})
+            logger.debug("Saved character state", extra={"character": self.current_character['name']})
         except Exception as e:
-            print(f"❌ Error saving character state: {e}")
+            logger.error("Error saving character state: %s", e)
+
+    def get_referenced_avatars(self) -> set:
+        """Get the avatar URLs that live character state still points at"""
+        referenced = set()
+        if self.current_character and self.current_character.get("avatar_path"):
+            referenced.add(self.current_character["avatar_path"])
+        return referenced
 
     def get_current_character(self) -> Dict[str, Any]:
         """Get current character information"""
@@ -189,58 +318,75 @@ Stay in character and keep the conversation flowing naturally. Don't contradict
             "avatar_path": "/static/default-avatar.png"
         }
 
-    def load_memory(self, file_path: str) -> Dict[str, str]:
-        """Load memory from JSON file"""
-        try:
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    return json.load(f)
-            return {}
-        except (FileNotFoundError, json.JSONDecodeError, PermissionError) as e:
-            print(f"⚠️ Could not load memory from {file_path}: {e}")
-            return {}
+    def _compact_document(self, file_path: str, document: Dict[str, Any]) -> Any:
+        """Hold memory files as compact MemoryLogs; other documents stay dicts"""
+        role = MEMORY_FILE_ROLES.get(os.path.basename(file_path))
+        return MemoryLog(role, document) if role is not None else document
+
+    def load_memory(self, file_path: str) -> MemoryLog:
+        """Load memory, including writes not yet committed; the result is read-only"""
+        return self.store.read(file_path)
 
     def save_memory(self, file_path: str, memory: Dict[str, str]):
-        """Save memory to JSON file"""
+        """Replace a memory file (persisted by the next group commit)"""
         try:
-            with open(file_path, 'w') as f:
-                json.dump(memory, f, indent=2)
-        except PermissionError as e:
-            print(f"⚠️ Could not save memory to {file_path}: {e}")
+            self.store.replace(file_path, memory)
         except Exception as e:
-            print(f"❌ Error saving memory to {file_path}: {e}")
+            logger.error("Error saving memory to %s: %s", file_path, e)
 
     def add_memory(self, file_path: str, content: str):
         """Add new memory entry with timestamp"""
         try:
-            memory = self.load_memory(file_path)
             timestamp = datetime.now().isoformat() + "Z"
-            memory[timestamp] = content
-            self.save_memory(file_path, memory)
+            self.store.set(file_path, timestamp, content)
         except Exception as e:
-            print(f"⚠️ Could not add memory to {file_path}: {e}")
+            logger.warning("Could not add memory to %s: %s", file_path, e)
+
+    def get_session_memory_files(self, session_id: Optional[str] = None) -> Tuple[str, str]:
+        """Get the (user, character) memory file paths for a session"""
+        if not session_id or session_id == DEFAULT_SESSION:
+            return self.user_memory_file, self.sally_memory_file
+        
+        if not re.match(SESSION_ID_PATTERN, session_id):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        
+        session_dir = os.path.join(self.memory_dir, "sessions", session_id)
+        try:
+            os.makedirs(session_dir, mode=0o777, exist_ok=True)
+        except Exception as e:
+            logger.warning("Could not create session directory %s: %s", session_dir, e)
+        return os.path.join(session_dir, "user.json"), os.path.join(session_dir, "sally.json")
+
+    def _session_lock(self, session_id: Optional[str]) -> asyncio.Lock:
+        """Get the lock serializing turns for a session"""
+        key = session_id or DEFAULT_SESSION
+        lock = self._session_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[key] = lock
+        return lock
 
-    def build_memory_summary(self) -> str:
+    def build_memory_summary(self, session_id: Optional[str] = None, exclude_turns: bool = False) -> str:
         """Build a summary of recent memories for the system prompt"""
-        user_memories = self.load_memory(self.user_memory_file)
-        sally_memories = self.load_memory(self.sally_memory_file)
+        user_memory_file, sally_memory_file = self.get_session_memory_files(session_id)
+        # Conversation turns are already sent as chat messages when excluded
+        turns = False if exclude_turns else None
+        # Get last 5 memories of each
+        recent_user = self.load_memory(user_memory_file).newest(5, turns)
+        recent_sally = self.load_memory(sally_memory_file).newest(5, turns)
         
         summary = "Recent memories:\n\n"
         
-        if user_memories:
+        if recent_user:
             summary += "About your friend:\n"
-            # Get last 5 user memories
-            recent_user = list(user_memories.items())[-5:]
-            for timestamp, memory in recent_user:
-                summary += f"- {memory}\n"
+            for entry in recent_user:
+                summary += f"- {entry.content}\n"
             summary += "\n"
         
-        if sally_memories:
+        if recent_sally:
             summary += "About yourself (Sally):\n"
-            # Get last 5 Sally memories
-            recent_sally = list(sally_memories.items())[-5:]
-            for timestamp, memory in recent_sally:
-                summary += f"- {memory}\n"
+            for entry in recent_sally:
+                summary += f"- {entry.content}\n"
         
         return summary.strip()
 
@@ -283,35 +429,77 @@ IMPORTANT: Stay consistent with the conversation. Read the context above careful
         
         return system_prompt, current_activity
 
-    async def process_message(self, user_message: str) -> Dict[str, Any]:
-        """Process user message and return Sally's response"""
+    def get_static_system_message(self) -> Dict[str, str]:
+        """Get the byte-identical system prefix for the current character"""
+        current_personality = (self.current_character["personality"] 
+                             if self.current_character and "personality" in self.current_character 
+                             else self.base_personality)
+        
+        message = self._static_prompt_cache.get(current_personality)
+        if message is None:
+            message = {"role": "system", "content": f"{current_personality}\n\n{CONSISTENCY_GUIDANCE}"}
+            # Only the active character's prefix is worth keeping around
+            self._static_prompt_cache = {current_personality: message}
+        return message
+
+    def get_conversation_turns(self, session_id: Optional[str] = None) -> List[Dict[str, str]]:
+        """Get recent turns as chat messages, oldest first.
         
+        The window start only advances in steps of HISTORY_WINDOW messages, so
+        consecutive requests share the same message prefix.
+        """
+        user_memory_file, sally_memory_file = self.get_session_memory_files(session_id)
+        user_log = self.load_memory(user_memory_file)
+        sally_log = self.load_memory(sally_memory_file)
+        
+        total = user_log.turn_count() + sally_log.turn_count()
+        start = max(0, (total - HISTORY_WINDOW) // HISTORY_WINDOW * HISTORY_WINDOW)
+        # The window's turns are among the newest (total - start) of each file
+        window = total - start
+        turns: List[MemoryEntry] = user_log.newest(window, turns=True) + sally_log.newest(window, turns=True)
+        turns.sort(key=lambda entry: entry.micros)
+        
+        chat_roles = {Role.USER: "user", Role.CHARACTER: "assistant"}
+        return [{"role": chat_roles[entry.role], "content": entry.text} for entry in turns[-window:]]
+
+    def build_volatile_context(self, session_id: Optional[str], response_style: str, user_msg_words: int) -> str:
+        """Build the per-turn context that goes after the cached prompt prefix"""
+        memory_summary = self.build_memory_summary(session_id, exclude_turns=True)
+        return f"""{self.get_current_time_context()}
+
+{memory_summary}
+
+Response guidance: {response_style}. User sent {user_msg_words} words - match their energy with a realistic response length."""
+
+    async def process_message(self, user_message: str, session_id: Optional[str] = None,
+                              simulate_delay: bool = True) -> Dict[str, Any]:
+        """Process user message and return Sally's response"""
+        async with self._session_lock(session_id):
+            # Raises UsageThrottledError for over-budget sessions sending too fast
+            self.usage.check(session_id or DEFAULT_SESSION)
+            return await self._process_message(user_message, session_id, simulate_delay)
+
+    def _observe_stage(self, stage: str, started: float):
+        """Report a pipeline stage's duration to the stage observer, if any"""
+        if self.stage_observer is not None:
+            self.stage_observer(stage, time.perf_counter() - started)
+
+    async def _process_message(self, user_message: str, session_id: Optional[str],
+                               simulate_delay: bool) -> Dict[str, Any]:
+        """Run one chat turn; callers hold the session lock"""
+        turn_started = time.perf_counter()
         try:
             # Check for /change command
             if user_message.strip().lower().startswith('/change'):
-                return await self.handle_personality_change(user_message)
+                return await self.handle_personality_change(user_message, session_id)
             
-            # Save user message to memory
-            self.add_memory(self.user_memory_file, f"User said: {user_message}")
-            
-            # Build system prompt with current memories (NO random activity during conversation)
-            character_desc = self.get_character_description()
-            memory_summary = self.build_memory_summary()
-            time_context = self.get_current_time_context()
+            user_memory_file, sally_memory_file = self.get_session_memory_files(session_id)
             
-            # Use current character's personality if available
-            current_personality = (self.current_character["personality"] 
-                                 if self.current_character and "personality" in self.current_character 
-                                 else self.base_personality)
+            # Load prior turns before this message is added to memory
+            history = self.get_conversation_turns(session_id)
             
-            # Build context-focused system prompt
-            system_prompt = f"""{current_personality}
-
-{time_context}
-
-{memory_summary}
-
-IMPORTANT: Stay consistent with the conversation. Don't randomly change what you're doing or where you are. Build on what you've already said and keep the conversation flowing naturally. Focus on responding to what the user just said."""
+            # Save user message to memory
+            self.add_memory(user_memory_file, f"{USER_TURN_PREFIX}{user_message}")
             
             # Determine response length based on user message style
             user_msg_words = len(user_message.split())
@@ -328,29 +516,43 @@ IMPORTANT: Stay consistent with the conversation. Don't randomly change what you
                 max_tokens = 120
                 response_style = "You can respond with more detail but stay conversational and realistic"
             
-            # Add response style guidance to system prompt
-            system_prompt += f"\n\nResponse guidance: {response_style}. User sent {user_msg_words} words - match their energy with a realistic response length."
+            # Static personality first, then append-only history, then volatile context
+            messages = [self.get_static_system_message()]
+            messages.extend(history)
+            messages.append({"role": "system", "content": self.build_volatile_context(session_id, response_style, user_msg_words)})
+            messages.append({"role": "user", "content": user_message})
+            self._observe_stage("prompt_assembly", turn_started)
             
             # Minimal realistic delay (0.3-1.0 seconds) - much faster than before
-            realistic_delay = random.uniform(0.3, 1.0)
-            await asyncio.sleep(realistic_delay)
+            if simulate_delay and SIMULATE_TYPING_DELAY:
+                realistic_delay = random.uniform(0.3, 1.0)
+                await asyncio.sleep(realistic_delay)
+            
+            # Fit the reply budget (and model) to the latency SLO, then to the session's token budget
+            budget = self.generation_budget.decide(max_tokens)
+            budget = self.usage.limit(session_id or DEFAULT_SESSION, budget)
             
             # Get response from Together AI
             try:
+                started = time.perf_counter()
                 response = await self.client.chat.completions.create(
-                    model="deepseek-ai/DeepSeek-V3",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_message}
-                    ],
+                    model=budget["model"],
+                    messages=messages,
                     temperature=0.8,
-                    max_tokens=max_tokens  # Dynamic based on user input
+                    max_tokens=budget["max_tokens"]  # Dynamic based on user input and upstream latency
                 )
                 
                 sally_reply = response.choices[0].message.content
                 
+                usage = getattr(response, "usage", None)
+                self.usage.record(session_id or DEFAULT_SESSION, "chat", budget["model"], usage)
+                completion_tokens = getattr(usage, "completion_tokens", None) or len(sally_reply.split())
+                self.generation_budget.observe(budget["model"], time.perf_counter() - started, completion_tokens)
+                self._observe_stage("upstream", started)
+                
                 # Save response to memory
-                self.add_memory(self.sally_memory_file, f"Character replied: {sally_reply}")
+                self.add_memory(sally_memory_file, f"{CHARACTER_TURN_PREFIX}{sally_reply}")
+                self._observe_stage("turn", turn_started)
                 
                 return {
                     "reply": sally_reply,
@@ -358,7 +560,7 @@ IMPORTANT: Stay consistent with the conversation. Don't randomly change what you
                 }
                 
             except Exception as api_error:
-                print(f"Together AI API error: {str(api_error)}")
+                logger.error("Together AI API error: %s", api_error)
                 # Return a quick fallback response
                 return {
                     "reply": "Hey! Sorry, I'm having some connection issues right now. Can you try again? 😅",
@@ -366,14 +568,68 @@ IMPORTANT: Stay consistent with the conversation. Don't randomly change what you
                 }
                 
         except Exception as e:
-            print(f"Process message error: {str(e)}")
+            logger.exception("Process message error: %s", e)
             # Return a generic error response
             return {
                 "reply": "Oops! Something went wrong on my end. Let me try to get back to normal... 🤔",
                 "timestamp": datetime.now().isoformat() + "Z"
             }
 
-    async def handle_personality_change(self, change_message: str) -> Dict[str, Any]:
+    async def process_batch(self, items: List[Tuple[Optional[str], str]],
+                            concurrency: Optional[int] = None,
+                            on_turn: Optional[Callable[[str, str, float, float, int], None]] = None
+                            ) -> AsyncIterator[Dict[str, Any]]:
+        """Run many (session_id, message) turns, yielding results as they finish.
+        
+        Turns of the same session run in submission order; different sessions
+        run concurrently, with at most `concurrency` turns in flight.
+        `on_turn(session_id, message, started, duration, status)` is called as
+        each turn that ran finishes, with an HTTP-style status.
+        """
+        semaphore = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+        results: asyncio.Queue = asyncio.Queue()
+        
+        # Group turns by session, keeping their original order
+        sessions: Dict[str, List[Tuple[int, str]]] = {}
+        for index, (session_id, message) in enumerate(items):
+            sessions.setdefault(session_id or DEFAULT_SESSION, []).append((index, message))
+        
+        batch_request_id = request_id_var.get()
+        
+        async def run_session(session_id: str, turns: List[Tuple[int, str]]):
+            for index, message in turns:
+                request_id_var.set(f"{batch_request_id}:{index}")
+                if message.strip().lower().startswith('/change'):
+                    # A transformation rewrites the shared character under only this session's lock
+                    await results.put({"index": index, "session_id": session_id,
+                                       "error": "/change is not supported in batches; send it to /chat"})
+                    continue
+                async with semaphore:
+                    started, timer = time.time(), time.perf_counter()
+                    try:
+                        result = await self.process_message(message, session_id, simulate_delay=False)
+                        record, status = {"index": index, "session_id": session_id, **result}, 200
+                    except Exception as e:
+                        record = {"index": index, "session_id": session_id, "error": str(e)}
+                        status = 429 if isinstance(e, UsageThrottledError) else 500
+                if on_turn is not None:
+                    try:
+                        on_turn(session_id, message, started, time.perf_counter() - timer, status)
+                    except Exception as e:
+                        logger.error("Batch turn callback failed: %s", e)
+                await results.put(record)
+        
+        tasks = [asyncio.create_task(run_session(session_id, turns))
+                 for session_id, turns in sessions.items()]
+        try:
+            for _ in range(len(items)):
+                yield await results.get()
+        finally:
+            # Stop outstanding work if the consumer goes away early
+            for task in tasks:
+                task.cancel()
+
+    async def handle_personality_change(self, change_message: str, session_id: Optional[str] = None) -> Dict[str, Any]:
         """Handle /change command to transform Sally's personality"""
         # Extract the new personality description
         change_text = change_message[7:].strip()  # Remove '/change'
@@ -384,19 +640,63 @@ IMPORTANT: Stay consistent with the conversation. Don't randomly change what you
                 "timestamp": datetime.now().isoformat() + "Z"
             }
         
-        # Initialize progress tracking
-        self.update_progress(10, "Initializing transformation...")
+        # Independent upstream calls run concurrently; each step waits only on what it needs
+        character_name = ""
+        graph = TaskGraph()
+        graph.add("personality", lambda results: self.generate_personality(change_text, session_id), weight=4)
+        graph.add("visual", lambda results: self.extract_visual_description(change_text, session_id=session_id), weight=2)
+        graph.add("image", lambda results: self._render_avatar_task(results["visual"], session_id), deps=["visual"], weight=4)
+        graph.add("character", lambda results: self._apply_new_character(change_text, results["personality"]),
+                  deps=["personality"])
+        graph.add("avatar", lambda results: self._save_avatar_task(results["character"], results["image"]),
+                  deps=["character", "image"])
+        
+        def report(fraction: float, task: str, results: Dict[str, Any]):
+            nonlocal character_name
+            character_name = results.get("character", character_name)
+            # 100% is left for the final status below
+            self.update_progress(min(99, int(fraction * 100)), TRANSFORMATION_STEP_STATUS[task], character_name)
         
-        # Auto-generate the full personality immediately
+        self.update_progress(0, "Generating personality and appearance...")
         try:
-            self.update_progress(25, "Generating personality...")
-            
-            response = await self.client.chat.completions.create(
-                model="deepseek-ai/DeepSeek-V3",
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": """Based on the character description provided, create a simple, natural personality for an AI companion that will text like a real person.
+            results = await graph.run(on_progress=report)
+        except Exception as e:
+            self.update_progress(0, f"Error: {str(e)}")
+            return {
+                "reply": f"Oops, something went wrong with the transformation: {str(e)}",
+                "timestamp": datetime.now().isoformat() + "Z"
+            }
+        
+        logger.info("Transformation tasks finished",
+                    extra={"character": character_name, "timings_ms": {name: round(seconds * 1000) for name, seconds in graph.timings.items()}})
+        new_avatar, avatar_error = results["avatar"]
+        response_data = {
+            "reply": f"Hey! What's up?",
+            "timestamp": datetime.now().isoformat() + "Z",
+            "new_avatar": new_avatar,
+            "character_name": character_name
+        }
+        if avatar_error:
+            self.update_progress(100, "Complete (avatar failed)", character_name)
+            response_data["avatar_info"] = f"Avatar generation failed: {avatar_error}"
+        elif new_avatar == "/static/default-avatar.png":
+            logger.warning("Avatar generation failed, using default avatar", extra={"character": character_name})
+            self.update_progress(100, "Complete (default avatar)", character_name)
+            response_data["avatar_info"] = "Avatar generation was blocked by content filters. Try simpler character descriptions if you'd like a custom image."
+        else:
+            logger.info("Character transformation complete", extra={"character": character_name, "avatar": new_avatar})
+            self.update_progress(100, "Transformation complete!", character_name)
+        return response_data
+
+    async def generate_personality(self, change_text: str, session_id: Optional[str] = None) -> str:
+        """Write a full personality prompt from a /change description"""
+
+        response = await self.client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {
+                    "role": "system", 
+                    "content": """Based on the character description provided, create a simple, natural personality for an AI companion that will text like a real person.
 
 ABSOLUTELY NO STAGE DIRECTIONS OR SCENE SETTING:
 - NEVER use *asterisks* or anything in brackets or parentheses
@@ -439,109 +739,43 @@ IMPORTANT - GENDER NEUTRAL LANGUAGE:
 - Stay inclusive and let them tell you who they are
 
 Stay in character but keep responses natural and brief. You're just a regular person."""
-                    },
-                    {
-                        "role": "user", 
-                        "content": f"Character description: {change_text}"
-                    }
-                ],
-                temperature=0.6,
-                max_tokens=400
-            )
-            
-            new_personality_prompt = response.choices[0].message.content.strip()
-            
-            # Extract character name from the new personality
-            character_name = self.extract_character_name(new_personality_prompt)
-            
-            self.update_progress(40, "Creating memories...", character_name)
-            
-            # Reset memory and set new personality
-            self.reset_memory()
-            
-            self.update_progress(55, "Crafting backstory...", character_name)
-            
-            # Create new character state
-            self.current_character = {
-                "name": character_name,
-                "description": change_text,
-                "avatar_path": "/static/default-avatar.png",
-                "created_at": datetime.now().isoformat() + "Z",
-                "personality": new_personality_prompt
-            }
-            
-            # Update base personality to use the new one
-            self.base_personality = new_personality_prompt
-            
-            # Store the new character state
-            self.save_character_state()
-            self.add_memory(self.sally_memory_file, f"Character personality was changed to: {change_text}")
-
-            self.update_progress(70, "Designing appearance...", character_name)
-
-            # Generate new avatar for the character using the detailed personality
-            try:
-                print(f"Generating avatar for new character {character_name} using personality description...")
-                
-                self.update_progress(75, "Generating avatar...", character_name)
-                
-                # Use the personality for more detailed photo generation
-                new_avatar = await self.generate_character_photo(character_name, change_text, force_generate=True)
-                
-                # Check if avatar generation succeeded or failed
-                if new_avatar != "/static/default-avatar.png":
-                    self.update_progress(90, "Finalizing avatar...", character_name)
-                    
-                    self.current_character["avatar_path"] = new_avatar
-                    self.save_character_state()
-                    print(f"✅ Character transformation complete: {character_name} with avatar: {new_avatar}")
-                    print(f"🔒 Avatar persisted - will not regenerate on page refresh")
-                    
-                    self.update_progress(100, "Transformation complete!", character_name)
-                    
-                    # Create response with the actual generated avatar
-                    response_data = {
-                        "reply": f"Hey! What's up?",
-                        "timestamp": datetime.now().isoformat() + "Z",
-                        "new_avatar": new_avatar,  # Use the generated avatar
-                        "character_name": character_name
-                    }
-                else:
-                    print(f"⚠️ Avatar generation failed, using default avatar")
-                    
-                    self.update_progress(100, "Complete (default avatar)", character_name)
-                    
-                    # Create response with default avatar
-                    response_data = {
-                        "reply": f"Hey! What's up?",
-                        "timestamp": datetime.now().isoformat() + "Z",
-                        "new_avatar": "/static/default-avatar.png",
-                        "character_name": character_name,
-                        "avatar_info": "Avatar generation was blocked by content filters. Try simpler character descriptions if you'd like a custom image."
-                    }
-                    
-            except Exception as avatar_error:
-                print(f"❌ Avatar generation failed: {avatar_error}")
-                
-                self.update_progress(100, "Complete (avatar failed)", character_name)
-                
-                # Create response with default avatar and error info
-                response_data = {
-                    "reply": f"Hey! What's up?",
-                    "timestamp": datetime.now().isoformat() + "Z",
-                    "new_avatar": "/static/default-avatar.png",
-                    "character_name": character_name,
-                    "avatar_info": f"Avatar generation failed: {str(avatar_error)}"
+                },
+                {
+                    "role": "user", 
+                    "content": f"Character description: {change_text}"
                 }
+            ],
+            temperature=0.6,
+            max_tokens=400
+        )
+        self.usage.record(session_id or DEFAULT_SESSION, "personality", CHAT_MODEL, getattr(response, "usage", None))
+        
+        return response.choices[0].message.content.strip()
 
-            return response_data
-            
-        except Exception as e:
-            self.update_progress(0, f"Error: {str(e)}")
-            return {
-                "reply": f"Oops, something went wrong with the transformation: {str(e)}",
-                "timestamp": datetime.now().isoformat() + "Z"
-            }
+    def _apply_new_character(self, change_text: str, new_personality_prompt: str) -> str:
+        """Switch to the new personality with fresh memory; returns the character's name"""
+        # Extract character name from the new personality
+        character_name = self.extract_character_name(new_personality_prompt)
+        
+        # Reset memory and set new personality
+        self.reset_memory()
+        
+        # Create new character state
+        self.current_character = {
+            "name": character_name,
+            "description": change_text,
+            "avatar_path": "/static/default-avatar.png",
+            "created_at": datetime.now().isoformat() + "Z",
+            "personality": new_personality_prompt
+        }
+        
+        # Update base personality to use the new one
+        self.base_personality = new_personality_prompt
+        
+        # Store the new character state
+        self.save_character_state()
+        self.add_memory(self.sally_memory_file, f"Character personality was changed to: {change_text}")
+        return character_name
 
     def extract_character_name(self, personality_prompt: str) -> str:
         """Extract character name from the personality prompt"""
@@ -562,36 +796,36 @@ Stay in character but keep responses natural and brief. You're just a regular pe
         except:
             return "Character"
 
-    def get_memory(self) -> Dict[str, Any]:
-        """Get current memory state (for debugging/viewing)"""
-        return {
-            "user_memory": self.load_memory(self.user_memory_file),
-            "sally_memory": self.load_memory(self.sally_memory_file),
-            "base_personality": self.base_personality
-        }
+    def iter_memory(self, session_id: Optional[str] = None, role: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None,
+                    cursor: Optional[str] = None) -> Iterator[Dict[str, str]]:
+        """Stream a session's memory entries in time order without loading the files whole"""
+        user_memory_file, sally_memory_file = self.get_session_memory_files(session_id)
+        return iter_memory_entries(user_memory_file, sally_memory_file, role, since, until, cursor)
+
+    def get_memory_page(self, session_id: Optional[str] = None, role: Optional[str] = None,
+                        since: Optional[str] = None, until: Optional[str] = None,
+                        cursor: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """Get one page of memory entries plus the cursor for the next page (for debugging/viewing)"""
+        items = []
+        next_cursor = None
+        for entry in self.iter_memory(session_id, role, since, until, cursor):
+            if len(items) == limit:
+                last = items[-1]
+                next_cursor = encode_cursor(last["timestamp"], last["role"])
+                break
+            items.append(entry)
+        return {"items": items, "next_cursor": next_cursor}
 
     def reset_memory(self):
         """Reset/reinitialize memory files - complete wipe for new character"""
-        print(f"🗑️ Resetting memory for new character...")
-        
-        # Completely remove old memory files
-        if os.path.exists(self.user_memory_file):
-            os.remove(self.user_memory_file)
-            print(f"🗑️ Removed old user memory")
-        if os.path.exists(self.sally_memory_file):
-            os.remove(self.sally_memory_file)
-            print(f"🗑️ Removed old character memory")
-        
-        # Create fresh empty memory files
-        with open(self.user_memory_file, 'w') as f:
-            json.dump({}, f, indent=2)
-        print(f"✅ Created fresh user memory file")
+        logger.info("Resetting memory for new character")
         
-        with open(self.sally_memory_file, 'w') as f:
-            json.dump({}, f, indent=2)
-        print(f"✅ Created fresh character memory file")
+        # Replace both memory files with fresh empty ones
+        self.save_memory(self.user_memory_file, {})
+        self.save_memory(self.sally_memory_file, {})
         
-        print(f"🎯 Memory reset complete - fresh start for new character")
+        logger.info("Memory reset complete")
 
     def get_character_description(self) -> str:
         """
@@ -662,9 +896,12 @@ Stay in character but keep responses natural and brief. You're just a regular pe
     def get_current_time_context(self) -> str:
         """Get a human-readable string for the current time of day"""
         now = datetime.now()
-        day_of_week = now.strftime('%A')
-        time_period = self.get_time_period(now.hour)
-        return f"It's currently {day_of_week} {time_period}."
+        key = (now.strftime('%A'), self.get_time_period(now.hour))
+        cached_key, cached_context = self._time_context_cache
+        if cached_key != key:
+            cached_context = f"It's currently {key[0]} {key[1]}."
+            self._time_context_cache = (key, cached_context)
+        return cached_context
 
     async def generate_character_photo(self, character_name: str, character_description: str, force_generate: bool = False) -> str:
         """Generate a realistic profile photo for the character using Together AI's FLUX.1 [schnell] Free"""
@@ -673,142 +910,162 @@ Stay in character but keep responses natural and brief. You're just a regular pe
             if not force_generate and self.current_character:
                 if (self.current_character["name"] == character_name and 
                     self.current_character["avatar_path"] != "/static/default-avatar.png"):
-                    print(f"Character {character_name} already has an avatar: {self.current_character['avatar_path']}")
+                    logger.debug("Character already has an avatar", extra={"character": character_name, "avatar": self.current_character['avatar_path']})
                     return self.current_character["avatar_path"]
             
-            # Try multiple avatar storage directories
-            avatar_directories = [
-                ("static/avatars", "/static/avatars"),  # Main directory
-                ("/tmp/sally_avatars", "/tmp_avatars")   # Fallback directory (mounted at /tmp_avatars)
-            ]
-            
-            avatar_saved = False
-            avatar_url = "/static/default-avatar.png"
-            
-            # Get the most detailed description available - use the actual character description
-            description_for_photo = character_description
-            
             # If this is the current character and we have a personality, extract visual details from it
             if (self.current_character and 
                 self.current_character["name"] == character_name and 
                 "personality" in self.current_character):
-                
-                try:
-                    # Extract visual description from personality using AI
-                    visual_response = await self.client.chat.completions.create(
-                        model="deepseek-ai/DeepSeek-V3",
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": "Extract physical appearance details from this character personality description. Focus on age, profession, style, and any visual characteristics mentioned. Create a concise description suitable for portrait generation."
-                            },
-                            {
-                                "role": "user", 
-                                "content": self.current_character["personality"]
-                            }
-                        ],
-                        temperature=0.3,
-                        max_tokens=150
-                    )
-                    
-                    extracted_description = visual_response.choices[0].message.content.strip()
-                    description_for_photo = f"{character_name}, {extracted_description}"
-                    print(f"Using personality-based description for photo: {description_for_photo}")
-                    
-                except Exception as extract_error:
-                    print(f"Failed to extract visual details from personality, using basic description: {extract_error}")
-                    description_for_photo = f"{character_name}, {character_description}"
+                extracted_description = await self.extract_visual_description(
+                    self.current_character["personality"], fallback=character_description)
+                description_for_photo = f"{character_name}, {extracted_description}"
             else:
                 description_for_photo = f"{character_name}, {character_description}"
             
-            # Create a detailed prompt using the actual character description
-            prompt = f"Professional headshot portrait of {description_for_photo}. High quality studio lighting, friendly expression, looking directly at camera, realistic photography style, sharp focus, professional portrait photography"
+            image_data = await self.render_character_image(description_for_photo)
+            if image_data is None:
+                logger.warning("No image data received from Together AI - using default avatar")
+                return "/static/default-avatar.png"
             
-            print(f"Generating new photo for {character_name} with full character description...")
-            print(f"Prompt: {prompt}")
+            avatar_url = self.save_avatar_image(character_name, image_data)
+            if avatar_url is None:
+                return "/static/default-avatar.png"
             
-            # Use Together AI's FLUX.1-schnell-Free model
-            response = await self.client.images.generate(
-                prompt=prompt,
-                model="black-forest-labs/FLUX.1-schnell-Free",
-                steps=4,
-                response_format="base64"
-            )
+            # Update character state with new avatar
+            if self.current_character and self.current_character["name"] == character_name:
+                self.current_character["avatar_path"] = avatar_url
+                self.save_character_state()
+                logger.debug("Updated character state with avatar", extra={"character": character_name, "avatar": avatar_url})
             
-            if response.data and len(response.data) > 0:
-                # Get the base64 image data
-                image_b64 = response.data[0].b64_json
-                image_data = base64.b64decode(image_b64)
-                avatar_filename = f"{character_name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                
-                # Try to save to each directory until one works
-                for directory_path, url_prefix in avatar_directories:
-                    try:
-                        # Create avatars directory if it doesn't exist
-                        os.makedirs(directory_path, mode=0o777, exist_ok=True)
-                        
-                        # Try to write the avatar file
-                        avatar_path = os.path.join(directory_path, avatar_filename)
-                        with open(avatar_path, "wb") as f:
-                            f.write(image_data)
-                        
-                        avatar_url = f"{url_prefix}/{avatar_filename}"
-                        print(f"✅ Successfully saved avatar to: {avatar_path} -> {avatar_url}")
-                        avatar_saved = True
-                        break
-                        
-                    except PermissionError as pe:
-                        print(f"❌ Permission denied saving to {directory_path}: {pe}")
-                        continue
-                    except Exception as e:
-                        print(f"❌ Failed to save to {directory_path}: {e}")
-                        continue
-                
-                if avatar_saved:
-                    # Update character state with new avatar
-                    if self.current_character and self.current_character["name"] == character_name:
-                        self.current_character["avatar_path"] = avatar_url
-                        self.save_character_state()
-                        print(f"Updated character state - {character_name} avatar persisted: {avatar_url}")
-                    
-                    return avatar_url
-                else:
-                    print("❌ Could not save avatar to any directory due to permission issues")
-                    return "/static/default-avatar.png"
-            else:
-                print("No image data received from Together AI - using default avatar")
-                return "/static/default-avatar.png"
+            return avatar_url
 
         except Exception as e:
-            error_message = str(e)
-            print(f"Image generation error: {error_message}")
-            
-            # Simple error handling - just use default avatar
-            if "rate_limit" in error_message.lower():
-                print(f"⏰ Rate limit hit for image generation. Character {character_name} will use default avatar.")
-            else:
-                print(f"❌ Image generation failed: {error_message}")
-            
+            self._log_image_error(character_name, e)
             # Always return default avatar on any error
             return "/static/default-avatar.png"
 
+    async def extract_visual_description(self, source: str, fallback: Optional[str] = None,
+                                         session_id: Optional[str] = None) -> str:
+        """Extract physical appearance details for a portrait, falling back to `fallback` (or `source`) on error"""
+        try:
+            visual_response = await self.client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Extract physical appearance details from this character personality description. Focus on age, profession, style, and any visual characteristics mentioned. Create a concise description suitable for portrait generation."
+                    },
+                    {
+                        "role": "user", 
+                        "content": source
+                    }
+                ],
+                temperature=0.3,
+                max_tokens=150
+            )
+            self.usage.record(session_id or DEFAULT_SESSION, "visual", CHAT_MODEL, getattr(visual_response, "usage", None))
+            extracted_description = visual_response.choices[0].message.content.strip()
+            logger.debug("Using extracted description for photo", extra={"description": extracted_description, "sampled": True})
+            return extracted_description
+        except Exception as extract_error:
+            logger.warning("Failed to extract visual details, using basic description: %s", extract_error)
+            return fallback if fallback is not None else source
+
+    async def render_character_image(self, description_for_photo: str, session_id: Optional[str] = None) -> Optional[bytes]:
+        """Render a portrait with FLUX; returns PNG bytes, or None if no image came back"""
+        # Create a detailed prompt using the actual character description
+        prompt = f"Professional headshot portrait of {description_for_photo}. High quality studio lighting, friendly expression, looking directly at camera, realistic photography style, sharp focus, professional portrait photography"
+        
+        logger.info("Generating new photo", extra={"prompt_chars": len(prompt)})
+        logger.debug("Image prompt", extra={"prompt": prompt, "sampled": True})
+        
+        # Use Together AI's FLUX.1-schnell-Free model
+        response = await self.client.images.generate(
+            prompt=prompt,
+            model=IMAGE_MODEL,
+            steps=4,
+            response_format="base64"
+        )
+        self.usage.record(session_id or DEFAULT_SESSION, "image", IMAGE_MODEL, images=len(response.data or []))
+        
+        if response.data and len(response.data) > 0:
+            return base64.b64decode(response.data[0].b64_json)
+        return None
+
+    def save_avatar_image(self, character_name: str, image_data: bytes) -> Optional[str]:
+        """Save an avatar to the first writable avatar directory; returns its URL, or None"""
+        avatar_filename = f"{character_name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
+        
+        # Try to save to each directory until one works
+        for directory_path, url_prefix in AVATAR_DIRECTORIES:
+            try:
+                # Create avatars directory if it doesn't exist
+                os.makedirs(directory_path, mode=0o777, exist_ok=True)
+                
+                # Try to write the avatar file
+                avatar_path = os.path.join(directory_path, avatar_filename)
+                with open(avatar_path, "wb") as f:
+                    f.write(image_data)
+                
+                avatar_url = f"{url_prefix}/{avatar_filename}"
+                logger.info("Saved avatar", extra={"path": avatar_path, "avatar": avatar_url})
+                return avatar_url
+                
+            except PermissionError as pe:
+                logger.warning("Permission denied saving avatar to %s: %s", directory_path, pe)
+                continue
+            except Exception as e:
+                logger.warning("Failed to save avatar to %s: %s", directory_path, e)
+                continue
+        
+        logger.error("Could not save avatar to any directory")
+        return None
+
+    def _log_image_error(self, character_name: str, error: Exception):
+        """Log a failed image generation"""
+        error_message = str(error)
+        # Simple error handling - just use default avatar
+        if "rate_limit" in error_message.lower():
+            logger.warning("Rate limit hit for image generation, using default avatar", extra={"character": character_name})
+        else:
+            logger.error("Image generation failed: %s", error_message)
+
+    async def _render_avatar_task(self, description_for_photo: str,
+                                  session_id: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """/change task: render the avatar, returning (image, None) or (None, error)"""
+        try:
+            return await self.render_character_image(description_for_photo, session_id), None
+        except Exception as e:
+            self._log_image_error("", e)
+            return None, str(e)
+
+    def _save_avatar_task(self, character_name: str, image: Tuple[Optional[bytes], Optional[str]]) -> Tuple[str, Optional[str]]:
+        """/change task: save the rendered avatar for the new character, returning (avatar URL, error)"""
+        image_data, error = image
+        if error is not None:
+            return "/static/default-avatar.png", error
+        if image_data is None:
+            logger.warning("No image data received from Together AI - using default avatar")
+            return "/static/default-avatar.png", None
+        avatar_url = self.save_avatar_image(character_name, image_data)
+        if avatar_url is None:
+            return "/static/default-avatar.png", None
+        if self.current_character and self.current_character["name"] == character_name:
+            self.current_character["avatar_path"] = avatar_url
+            self.save_character_state()
+        return avatar_url, None
+
     def get_recent_conversation_context(self) -> str:
         """Get recent conversation context for better contextual responses"""
-        user_memories = self.load_memory(self.user_memory_file)
-        sally_memories = self.load_memory(self.sally_memory_file)
-        
         # Get last 3 exchanges to maintain context
         recent_context = "Last few messages:\n"
         
-        if user_memories:
-            recent_user = list(user_memories.items())[-3:]
-            for timestamp, memory in recent_user:
-                recent_context += f"- {memory}\n"
+        for entry in self.load_memory(self.user_memory_file).newest(3):
+            recent_context += f"- {entry.content}\n"
         
-        if sally_memories:
-            recent_sally = list(sally_memories.items())[-3:]
-            for timestamp, memory in recent_sally:
-                recent_context += f"- {memory}\n"
+        for entry in self.load_memory(self.sally_memory_file).newest(3):
+            recent_context += f"- {entry.content}\n"
         
         return recent_context.strip()
 
@@ -821,26 +1078,32 @@ Stay in character but keep responses natural and brief. You're just a regular pe
                 "character_name": character_name,
                 "timestamp": datetime.now().isoformat() + "Z"
             }
+            self._progress = progress_data
+            self.progress_state.bump()
+            if self.event_bus is not None:
+                self.event_bus.publish("progress", {"version": self.progress_state.version, "progress": progress_data})
             with open(self.progress_file, 'w') as f:
                 json.dump(progress_data, f, indent=2)
-            print(f"📊 Progress updated: {progress}% - {status}")
+            logger.debug("Progress updated", extra={"progress": progress, "status": status, "sampled": True})
         except PermissionError as pe:
-            print(f"❌ Permission error updating progress: {pe}")
+            logger.warning("Permission error updating progress: %s", pe)
             # Don't raise - progress tracking is not critical for core functionality
         except Exception as e:
-            print(f"❌ Error updating progress: {e}")
+            logger.error("Error updating progress: %s", e)
             # Don't raise - progress tracking is not critical for core functionality
 
     def get_progress(self) -> Dict[str, Any]:
         """Get current transformation progress"""
+        if self._progress is not None:
+            return self._progress
         try:
             if os.path.exists(self.progress_file):
                 with open(self.progress_file, 'r') as f:
                     return json.load(f)
             return {"progress": 0, "status": "Not started", "character_name": ""}
         except PermissionError as pe:
-            print(f"❌ Permission error reading progress: {pe}")
+            logger.warning("Permission error reading progress: %s", pe)
             return {"progress": 0, "status": "Permission error", "character_name": ""}
         except Exception as e:
-            print(f"❌ Error reading progress: {e}")
+            logger.error("Error reading progress: %s", e)
             return {"progress": 0, "status": "Error reading progress", "character_name": ""}
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Optional
+
+from logging_config import get_logger
+
+logger = get_logger("diagnostics")
+
+# Heartbeat period of the event-loop lag monitor
+LOOP_MONITOR_INTERVAL_MS = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))
+# A callback holding the loop longer than this is reported with its stack (0 disables the monitor)
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "250"))
+# Sampling profiler frequency
+PROFILE_SAMPLE_HZ = float(os.getenv("PROFILE_SAMPLE_HZ", "200"))
+# Longest profile an admin may request
+PROFILE_MAX_SECONDS = 120
+
+
+def _frame_stack(frame) -> list:
+    """Function names from the outermost frame to `frame`"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class LoopLagMonitor:
+    """Reports event-loop stalls along with the stack of whatever is blocking the loop.
+
+    A coroutine on the loop stamps a heartbeat; a watchdog thread notices
+    when the heartbeat goes stale and grabs the loop thread's current frame.
+    """
+
+    def __init__(self, interval_ms: float = LOOP_MONITOR_INTERVAL_MS, threshold_ms: float = LOOP_STALL_THRESHOLD_MS):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.max_lag_ms = 0.0
+        self.stalls = 0
+        self.recent_stalls: Deque[Dict[str, Any]] = deque(maxlen=20)
+
+    async def _beat(self):
+        """Stamp the heartbeat and measure how late each wakeup is"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.max_lag_ms = max(self.max_lag_ms, (now - expected) * 1000)
+            self._heartbeat = now
+
+    def _watch(self):
+        """Watchdog thread: capture the loop's stack once per stall"""
+        reported_heartbeat = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            stall = {"stalled_ms": round(stalled_for * 1000, 1), "at": time.time(), "stack": stack}
+            self.stalls += 1
+            self.recent_stalls.append(stall)
+            logger.warning("Event loop stalled", extra=stall)
+
+    def start(self):
+        """Start the heartbeat and the watchdog thread"""
+        if self.threshold <= 0 or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        """Stop monitoring"""
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Snapshot of observed loop lag"""
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "stalls": self.stalls,
+            "recent_stalls": list(self.recent_stalls),
+        }
+
+
+class ProfilerBusyError(RuntimeError):
+    """Raised when a profile is requested while another is being captured"""
+
+
+class Profiler:
+    """Captures a CPU profile of the event-loop thread for a time window or a number of requests"""
+
+    def __init__(self):
+        self._capturing = False
+        self._requests_left = 0
+        self._requests_done: Optional[asyncio.Event] = None
+
+    def request_finished(self):
+        """Count a finished request toward a request-bounded capture"""
+        if self._requests_done is not None:
+            self._requests_left -= 1
+            if self._requests_left <= 0:
+                self._requests_done.set()
+
+    async def _wait(self, seconds: float, requests: int):
+        """Wait for the capture window: `seconds`, or until `requests` requests finish if sooner"""
+        if requests <= 0:
+            await asyncio.sleep(seconds)
+            return
+        self._requests_left = requests
+        self._requests_done = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._requests_done.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._requests_done = None
+
+    async def capture(self, mode: str, seconds: float, requests: int = 0) -> bytes:
+        """Profile the loop thread and return the result.
+
+        "sampling" returns collapsed stacks ("frame;frame;frame count" lines)
+        for flamegraph.pl, speedscope or inferno. "cprofile" returns a pstats
+        dump (.prof) for snakeviz, tuna or pstats. Work done in worker
+        threads is not included.
+        """
+        if self._capturing:
+            raise ProfilerBusyError("A profile is already being captured")
+        self._capturing = True
+        try:
+            if mode == "cprofile":
+                return await self._capture_cprofile(seconds, requests)
+            return await self._capture_sampling(seconds, requests)
+        finally:
+            self._capturing = False
+
+    async def _capture_cprofile(self, seconds: float, requests: int) -> bytes:
+        """Deterministic profile of everything the loop thread runs during the window"""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await self._wait(seconds, requests)
+        finally:
+            profile.disable()
+        profile.create_stats()
+        return marshal.dumps(profile.stats)
+
+    async def _capture_sampling(self, seconds: float, requests: int) -> bytes:
+        """Sample the loop thread's stack from a helper thread"""
+        loop_thread_id = threading.get_ident()
+        samples: Counter = Counter()
+        done = threading.Event()
+
+        def sample():
+            period = 1 / PROFILE_SAMPLE_HZ
+            while not done.wait(period):
+                frame = sys._current_frames().get(loop_thread_id)
+                if frame is not None:
+                    samples[";".join(_frame_stack(frame))] += 1
+
+        sampler = threading.Thread(target=sample, name="profile-sampler", daemon=True)
+        sampler.start()
+        try:
+            await self._wait(seconds, requests)
+        finally:
+            done.set()
+            await asyncio.to_thread(sampler.join)
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common()).encode()
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from logging_config import get_logger
+
+logger = get_logger("event_bus")
+
+# Set when running under `uvicorn --workers N` so workers share state through the bus
+MULTI_WORKER = os.getenv("MULTI_WORKER", "0") == "1"
+# How often each worker polls for events from the others
+EVENT_BUS_POLL_MS = float(os.getenv("EVENT_BUS_POLL_MS", "100"))
+# Events older than this are pruned; workers only ever need recent ones
+EVENT_RETENTION_SECONDS = 300
+
+
+class EventBus:
+    """Local cross-worker event bus backed by a SQLite notification table.
+
+    Every worker appends events to the same table and polls for rows newer
+    than the last one it saw, skipping its own. Published events are
+    written by a background task, off the event loop. Handlers run on the
+    receiving worker's event loop.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._handlers: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+        self._local = threading.local()
+        self._last_id = 0
+        self._last_prune = time.time()
+        self._task: Optional[asyncio.Task] = None
+        # Events published but not yet written, as table rows
+        self._outbox: List[tuple] = []
+        self._outbox_ready: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        connection = self._connection()
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS claims (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL)""")
+        # Only events published from now on matter to this worker
+        self._last_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        """Per-thread connection (polling runs in worker threads)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def subscribe(self, kind: str, handler: Callable[[Dict[str, Any]], None]):
+        """Call `handler(payload)` for events of `kind` published by other workers"""
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, payload: Dict[str, Any]):
+        """Announce an event to the other workers; it is written in the background"""
+        try:
+            self._outbox.append((self.worker_id, kind, json.dumps(payload), time.time()))
+        except (TypeError, ValueError) as e:
+            logger.error("Could not publish %s event: %s", kind, e)
+            return
+        if self._outbox_ready is not None:
+            self._outbox_ready.set()
+
+    def _insert(self, rows: List[tuple]):
+        """Write published events in one transaction"""
+        with self._connection() as connection:
+            connection.executemany("INSERT INTO events (origin, kind, payload, created) VALUES (?, ?, ?, ?)", rows)
+
+    async def _write_outbox(self):
+        """Write every event published so far"""
+        rows, self._outbox = self._outbox, []
+        if not rows:
+            return
+        try:
+            await asyncio.to_thread(self._insert, rows)
+        except Exception as e:
+            logger.error("Could not publish %d events: %s", len(rows), e)
+
+    async def write(self):
+        """Write published events as they come in"""
+        while True:
+            await self._outbox_ready.wait()
+            self._outbox_ready.clear()
+            await self._write_outbox()
+            if self._stopping:
+                return
+
+    def claim(self, name: str, ttl_seconds: float) -> bool:
+        """Try to become the one worker doing `name` for the next `ttl_seconds`"""
+        now = time.time()
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT owner, expires FROM claims WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != self.worker_id and row[1] > now:
+                connection.execute("COMMIT")
+                return False
+            connection.execute("INSERT OR REPLACE INTO claims (name, owner, expires) VALUES (?, ?, ?)",
+                               (name, self.worker_id, now + ttl_seconds))
+            connection.execute("COMMIT")
+            return True
+        except Exception as e:
+            # BEGIN itself may be what failed (database locked), leaving nothing to roll back
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            logger.error("Could not claim %s: %s", name, e)
+            return False
+
+    def _fetch(self) -> list:
+        """Read events newer than the last one seen, pruning old rows now and then"""
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT id, origin, kind, payload FROM events WHERE id > ? ORDER BY id",
+            (self._last_id,)).fetchall()
+        now = time.time()
+        if now - self._last_prune > EVENT_RETENTION_SECONDS:
+            self._last_prune = now
+            connection.execute("DELETE FROM events WHERE created < ?", (now - EVENT_RETENTION_SECONDS,))
+        return rows
+
+    async def run(self):
+        """Poll for events and dispatch them to local handlers"""
+        while True:
+            try:
+                rows = await asyncio.to_thread(self._fetch)
+            except Exception as e:
+                logger.error("Event bus poll failed: %s", e)
+                rows = []
+            for event_id, origin, kind, payload in rows:
+                self._last_id = event_id
+                if origin == self.worker_id:
+                    continue
+                for handler in self._handlers.get(kind, ()):
+                    try:
+                        handler(json.loads(payload))
+                    except Exception as e:
+                        logger.error("Error handling %s event: %s", kind, e)
+            await asyncio.sleep(EVENT_BUS_POLL_MS / 1000)
+
+    def start(self):
+        """Start polling and writing published events"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        if self._writer is None:
+            self._stopping = False
+            self._outbox_ready = asyncio.Event()
+            self._writer = asyncio.create_task(self.write())
+            if self._outbox:
+                self._outbox_ready.set()
+
+    async def stop(self):
+        """Stop polling and write the events still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            # Let the writer finish rather than cancel it mid-write and lose its batch
+            self._stopping = True
+            self._outbox_ready.set()
+            await self._writer
+            self._writer = self._outbox_ready = None
+        await self._write_outbox()
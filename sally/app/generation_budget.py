@@ -0,0 +1,192 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from logging_config import get_logger
+
+logger = get_logger("generation_budget")
+
+# Target p95 latency for a chat completion (0 disables the controller)
+LATENCY_SLO_MS = float(os.getenv("LATENCY_SLO_MS", "5000"))
+# Optional cheaper/faster model used when even the smallest budget misses the SLO
+FAST_MODEL = os.getenv("FAST_MODEL", "")
+# Never cut replies shorter than this many tokens
+MIN_MAX_TOKENS = int(os.getenv("MIN_MAX_TOKENS", "24"))
+# Number of recent completions per model used for the latency model
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+# Completions older than this no longer count towards a model's latency estimate (0 keeps them)
+LATENCY_SAMPLE_MAX_AGE_SECONDS = float(os.getenv("LATENCY_SAMPLE_MAX_AGE_SECONDS", "900"))
+# Share of fast-model routes sent to the default model anyway, so its estimate keeps up to date
+LATENCY_EXPLORE_RATE = float(os.getenv("LATENCY_EXPLORE_RATE", "0.05"))
+# Completions needed before a model's latency estimate is trusted
+MIN_SAMPLES = 20
+
+
+def _percentile(values, fraction: float) -> float:
+    """Nearest-rank percentile of a non-empty sequence"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class GenerationBudgetController:
+    """Picks max_tokens (and optionally a faster model) to keep chat p95 latency under the SLO.
+
+    Each model's latency is fitted as `overhead + seconds_per_token * tokens`
+    over a sliding window of recent completions. The p95 of the fit's
+    residuals is added as headroom, and the token budget is the largest one
+    whose predicted p95 still meets the SLO. While replies go to the fast
+    model, a few still go to the default one and old samples expire, so
+    the controller switches back once the default model recovers.
+    """
+
+    def __init__(self, default_model: str, slo_ms: float = LATENCY_SLO_MS, fast_model: str = FAST_MODEL):
+        self.default_model = default_model
+        self.fast_model = fast_model or None
+        self.slo_seconds = slo_ms / 1000.0
+        # (latency seconds, completion tokens, monotonic time observed) per model
+        self._samples: Dict[str, Deque[Tuple[float, int, float]]] = {}
+        self._fits: Dict[str, Optional[Tuple[float, float, float]]] = {}
+        self._lock = threading.Lock()
+        self._metrics = {
+            "decisions": 0,
+            "budget_reductions": 0,
+            "tokens_cut": 0,
+            "fast_model_routes": 0,
+            "exploration_routes": 0,
+            "completions": 0,
+            "slo_violations": 0,
+        }
+        self._last_decision: Optional[Dict[str, Any]] = None
+
+    def _fit(self, model: str) -> Optional[Tuple[float, float, float]]:
+        """Fit (overhead, seconds_per_token, p95_residual) for a model, or None without enough data"""
+        self._expire(model)
+        if model not in self._fits:
+            self._fits[model] = self._compute_fit(model)
+        return self._fits[model]
+
+    def _expire(self, model: str):
+        """Drop the model's samples older than LATENCY_SAMPLE_MAX_AGE_SECONDS"""
+        samples = self._samples.get(model)
+        if not samples or LATENCY_SAMPLE_MAX_AGE_SECONDS <= 0:
+            return
+        cutoff = time.monotonic() - LATENCY_SAMPLE_MAX_AGE_SECONDS
+        if samples[0][2] >= cutoff:
+            return
+        while samples and samples[0][2] < cutoff:
+            samples.popleft()
+        self._fits.pop(model, None)
+
+    def _compute_fit(self, model: str) -> Optional[Tuple[float, float, float]]:
+        """Least-squares latency fit over the model's sample window"""
+        samples = list(self._samples.get(model, ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        n = len(samples)
+        mean_tokens = sum(tokens for _, tokens, _ in samples) / n
+        mean_latency = sum(latency for latency, _, _ in samples) / n
+        variance = sum((tokens - mean_tokens) ** 2 for _, tokens, _ in samples)
+        if variance > 0:
+            covariance = sum((tokens - mean_tokens) * (latency - mean_latency) for latency, tokens, _ in samples)
+            per_token = max(covariance / variance, 0.0)
+            overhead = max(mean_latency - per_token * mean_tokens, 0.0)
+        else:
+            # All replies the same length: attribute everything to generation
+            per_token = mean_latency / max(mean_tokens, 1)
+            overhead = 0.0
+
+        residuals = [latency - (overhead + per_token * tokens) for latency, tokens, _ in samples]
+        return overhead, per_token, max(_percentile(residuals, 0.95), 0.0)
+
+    def _predict_p95(self, fit: Tuple[float, float, float], max_tokens: int) -> float:
+        """Predicted p95 latency if a reply uses its whole token budget"""
+        overhead, per_token, headroom = fit
+        return overhead + per_token * max_tokens + headroom
+
+    def _budget_for(self, fit: Tuple[float, float, float], requested: int) -> int:
+        """Largest token budget up to `requested` predicted to meet the SLO"""
+        overhead, per_token, headroom = fit
+        if per_token <= 0:
+            return requested
+        affordable = int((self.slo_seconds - overhead - headroom) / per_token)
+        return max(MIN_MAX_TOKENS, min(requested, affordable))
+
+    def decide(self, requested_max_tokens: int) -> Dict[str, Any]:
+        """Choose the model and max_tokens for the next chat completion"""
+        with self._lock:
+            decision = {"model": self.default_model, "max_tokens": requested_max_tokens, "reason": "default"}
+            fit = self._fit(self.default_model) if self.slo_seconds > 0 else None
+
+            if fit is not None:
+                budget = self._budget_for(fit, requested_max_tokens)
+                decision["max_tokens"] = budget
+                if budget < requested_max_tokens:
+                    decision["reason"] = "reduced_for_slo"
+
+                if self.fast_model and self._predict_p95(fit, budget) > self.slo_seconds:
+                    fast_fit = self._fit(self.fast_model)
+                    # Route to the fast model when it is expected to do better, or to learn how it does
+                    if fast_fit is None or self._predict_p95(fast_fit, requested_max_tokens) < self._predict_p95(fit, budget):
+                        if random.random() < LATENCY_EXPLORE_RATE:
+                            # Keep sampling the default model, or its stale fit would pin us to the fast one
+                            decision["reason"] = "explore_default_model"
+                            self._metrics["exploration_routes"] += 1
+                        else:
+                            decision["model"] = self.fast_model
+                            decision["max_tokens"] = (self._budget_for(fast_fit, requested_max_tokens)
+                                                      if fast_fit is not None else requested_max_tokens)
+                            decision["reason"] = "fast_model_for_slo"
+
+            self._metrics["decisions"] += 1
+            if decision["max_tokens"] < requested_max_tokens:
+                self._metrics["budget_reductions"] += 1
+                self._metrics["tokens_cut"] += requested_max_tokens - decision["max_tokens"]
+            if decision["model"] != self.default_model:
+                self._metrics["fast_model_routes"] += 1
+            self._last_decision = dict(decision, requested_max_tokens=requested_max_tokens)
+
+        if decision["reason"] != "default":
+            logger.debug("Generation budget adjusted", extra={**self._last_decision, "sampled": True})
+        return decision
+
+    def observe(self, model: str, latency_seconds: float, completion_tokens: int):
+        """Record how long a completion took and how many tokens it produced"""
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=LATENCY_WINDOW)
+            samples.append((latency_seconds, completion_tokens, time.monotonic()))
+            self._fits.pop(model, None)
+            self._metrics["completions"] += 1
+            if self.slo_seconds > 0 and latency_seconds > self.slo_seconds:
+                self._metrics["slo_violations"] += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Snapshot of controller decisions and observed latency per model"""
+        with self._lock:
+            models = {}
+            for model, samples in self._samples.items():
+                self._expire(model)
+                if not samples:
+                    continue
+                latencies = [latency for latency, _, _ in samples]
+                total_tokens = sum(tokens for _, tokens, _ in samples)
+                models[model] = {
+                    "samples": len(samples),
+                    "p50_latency_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+                    "p95_latency_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+                    "tokens_per_second": round(total_tokens / sum(latencies), 2) if sum(latencies) > 0 else None,
+                }
+            return {
+                "slo_ms": self.slo_seconds * 1000,
+                "default_model": self.default_model,
+                "fast_model": self.fast_model,
+                **self._metrics,
+                "last_decision": self._last_decision,
+                "models": models,
+            }
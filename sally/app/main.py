@@ -1,13 +1,33 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query, Depends, Header
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
+from pydantic import BaseModel, Field
 import os
-from typing import Dict, Any
-from chat import ChatHandler
+import json
+import asyncio
+import uuid
+import time
+import secrets
+from typing import Dict, Any, List, Optional, Literal
+from dotenv import load_dotenv
+
+# Load .env before importing app modules: they read their settings at import time
+load_dotenv()
+
+from logging_config import setup_logging, get_logger, request_id_var
+from chat import ChatHandler, SESSION_ID_PATTERN, AVATAR_DIRECTORIES
+from versioned_state import VersionedState
+from usage import UsageThrottledError
+from avatar_gc import AvatarSweeper
+from event_bus import EventBus, MULTI_WORKER
+from tracing import TraceRecorder
+from diagnostics import LoopLagMonitor, Profiler, ProfilerBusyError, PROFILE_MAX_SECONDS
 import base64
 import requests
 
+setup_logging()
+logger = get_logger("main")
+
 app = FastAPI(title="Sally - AI Companion Chatbot", version="1.0.0")
 
 # Mount static files
@@ -18,15 +38,60 @@ fallback_avatar_dir = "/tmp/sally_avatars"
 os.makedirs(fallback_avatar_dir, mode=0o777, exist_ok=True)
 try:
     app.mount("/tmp_avatars", StaticFiles(directory=fallback_avatar_dir), name="tmp_avatars")
-    print(f"✅ Mounted fallback avatar directory: {fallback_avatar_dir}")
+    logger.info("Mounted fallback avatar directory", extra={"path": fallback_avatar_dir})
 except Exception as e:
-    print(f"⚠️ Could not mount fallback avatar directory: {e}")
+    logger.warning("Could not mount fallback avatar directory: %s", e)
 
 # Initialize chat handler
 chat_handler = ChatHandler()
 
+# Background collector for avatars no character references anymore
+avatar_sweeper = AvatarSweeper(AVATAR_DIRECTORIES, chat_handler.get_referenced_avatars)
+
+# Anonymized /chat trace capture (enabled by TRACE_CAPTURE_FILE)
+trace_recorder = TraceRecorder()
+
+# Cross-worker event bus, created at startup in multi-worker mode
+event_bus: Optional[EventBus] = None
+
+# Event-loop stall reporting and on-demand CPU profiling
+loop_monitor = LoopLagMonitor()
+profiler = Profiler()
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Tag every log record emitted while handling a request with its correlation id"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:12]
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+        if not request.url.path.startswith("/admin/"):
+            profiler.request_finished()
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# Maximum number of turns accepted by a single /chat/batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+# Largest page size accepted by GET /memory
+MEMORY_PAGE_MAX = 500
+# Longest a /character or /progress long-poll may wait for a change
+LONG_POLL_MAX_SECONDS = 60
+# Shared secret for /admin endpoints (sent as X-Admin-Token); unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 class ChatMessage(BaseModel):
     message: str
+    session_id: Optional[str] = Field(default=None, pattern=SESSION_ID_PATTERN)
+
+class BatchChatItem(BaseModel):
+    message: str
+    session_id: Optional[str] = Field(default=None, pattern=SESSION_ID_PATTERN)
+
+class BatchChatRequest(BaseModel):
+    items: List[BatchChatItem]
+    concurrency: Optional[int] = Field(default=None, ge=1, le=64)
 
 class ChatResponse(BaseModel):
     reply: str
@@ -39,28 +104,55 @@ class PhotoRequest(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     """Initialize memory files and ensure character has proper avatar on startup"""
+    global event_bus
+    loop_monitor.start()
     chat_handler.initialize_memory()
+    chat_handler.store.start()
+    chat_handler.usage.start()
+    
+    if MULTI_WORKER:
+        try:
+            event_bus = EventBus(os.path.join(chat_handler.memory_dir, "events.db"))
+            chat_handler.attach_event_bus(event_bus)
+            event_bus.start()
+            logger.info("Joined cross-worker event bus", extra={"worker": event_bus.worker_id})
+        except Exception as e:
+            event_bus = None
+            logger.error("Could not open cross-worker event bus, workers will not share state: %s", e)
     
     # Get current character state
     character = chat_handler.get_current_character()
-    print(f"Loaded character: {character['name']} with avatar: {character['avatar_path']}")
+    logger.info("Loaded character", extra={"character": character['name'], "avatar": character['avatar_path']})
     
     # Only generate avatar if explicitly using default avatar (never regenerate existing photos)
-    if character['avatar_path'] == "/static/default-avatar.png":
-        print(f"Character {character['name']} has no custom avatar - generating initial photo...")
+    if character['avatar_path'] == "/static/default-avatar.png" and event_bus is not None and not event_bus.claim("startup_avatar", 600):
+        logger.info("Another worker is generating the initial avatar", extra={"character": character['name']})
+    elif character['avatar_path'] == "/static/default-avatar.png":
+        logger.info("Character has no custom avatar - generating initial photo", extra={"character": character['name']})
         try:
             avatar_url = await chat_handler.generate_character_photo(
                 character['name'], 
                 character.get('description', f"{character['name']} - AI companion"),
                 force_generate=True
             )
-            print(f"✅ Avatar generated and persisted for {character['name']}: {avatar_url}")
+            logger.info("Avatar generated and persisted", extra={"character": character['name'], "avatar": avatar_url})
         except Exception as e:
-            print(f"❌ Failed to generate avatar for {character['name']}: {e}")
-            print("Character will use default avatar")
+            logger.error("Failed to generate avatar for %s, using default avatar: %s", character['name'], e)
     else:
-        print(f"✅ Character {character['name']} already has custom avatar: {character['avatar_path']}")
-        print("🔒 Photo generation skipped - existing avatar preserved")
+        logger.info("Existing avatar preserved", extra={"character": character['name'], "avatar": character['avatar_path']})
+    
+    avatar_sweeper.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background tasks and drain pending writes to disk"""
+    await avatar_sweeper.stop()
+    await chat_handler.usage.stop()
+    await chat_handler.store.drain()
+    if event_bus is not None:
+        await event_bus.stop()
+    await loop_monitor.stop()
+    trace_recorder.close()
 
 @app.get("/", response_class=HTMLResponse)
 async def web_interface():
@@ -74,11 +166,35 @@ async def web_interface():
 @app.post("/chat", response_model=ChatResponse)
 async def chat(chat_message: ChatMessage):
     """Send a message to Sally and get her response"""
+    started, timer = time.time(), time.perf_counter()
+    status = 200
     try:
-        response = await chat_handler.process_message(chat_message.message)
+        response = await chat_handler.process_message(chat_message.message, chat_message.session_id)
         return response
+    except UsageThrottledError as e:
+        status = 429
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
+        status = 500
         raise HTTPException(status_code=500, detail=f"Chat error: {str(e)}")
+    finally:
+        trace_recorder.record(chat_message.session_id, chat_message.message, started,
+                              time.perf_counter() - timer, status)
+
+@app.post("/chat/batch")
+async def chat_batch(batch_request: BatchChatRequest):
+    """Run many independent chat turns and stream the results back as NDJSON"""
+    if len(batch_request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch too large: at most {BATCH_MAX_ITEMS} items")
+    
+    items = [(item.session_id, item.message) for item in batch_request.items]
+    
+    async def stream_results():
+        async for result in chat_handler.process_batch(items, batch_request.concurrency,
+                                                       on_turn=trace_recorder.record):
+            yield json.dumps(result) + "\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
 
 @app.post("/generate_photo")
 async def generate_photo(photo_request: PhotoRequest):
@@ -94,18 +210,36 @@ async def generate_photo(photo_request: PhotoRequest):
         if current_character and current_character["name"] == photo_request.character_name:
             current_character["avatar_path"] = avatar_url
             chat_handler.save_character_state()
-            print(f"Updated character state with new avatar: {avatar_url}")
+            logger.info("Updated character state with new avatar", extra={"avatar": avatar_url})
         
         return {"avatar_url": avatar_url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Photo generation error: {str(e)}")
 
 @app.get("/memory")
-async def get_memory():
-    """Get current memory state (for debugging/viewing)"""
+async def get_memory(
+    session_id: Optional[str] = Query(default=None, pattern=SESSION_ID_PATTERN),
+    role: Optional[Literal["user", "character"]] = None,
+    since: Optional[str] = Query(default=None, description="Inclusive ISO timestamp or prefix, e.g. 2025-01-20"),
+    until: Optional[str] = Query(default=None, description="Exclusive ISO timestamp or prefix"),
+    cursor: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=MEMORY_PAGE_MAX),
+    format: Literal["json", "ndjson"] = "json",
+):
+    """List memory entries page by page, or export them all as NDJSON (for debugging/viewing)"""
     try:
-        memory = chat_handler.get_memory()
-        return memory
+        # Listing reads the files directly, so commit pending writes first
+        await chat_handler.store.flush()
+        
+        if format == "ndjson":
+            entries = chat_handler.iter_memory(session_id, role, since, until, cursor)
+            # Sync generator: Starlette drains it in a worker thread, off the event loop
+            lines = (json.dumps(entry) + "\n" for entry in entries)
+            return StreamingResponse(lines, media_type="application/x-ndjson")
+        
+        return await asyncio.to_thread(chat_handler.get_memory_page, session_id, role, since, until, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Memory error: {str(e)}")
 
@@ -118,24 +252,76 @@ async def reset_memory():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Reset error: {str(e)}")
 
+async def versioned_response(state: VersionedState, request: Request,
+                             version: Optional[int], timeout: float) -> Response:
+    """Serve versioned state: optionally wait for a version newer than `version`, and answer 304 when the client's ETag is current"""
+    if version is not None:
+        await state.wait_newer(version, timeout)
+    headers = {"ETag": state.etag, "X-State-Version": str(state.version), "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or state.etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=state.body(), media_type="application/json", headers=headers)
+
 @app.get("/character")
-async def get_current_character():
+async def get_current_character(
+    request: Request,
+    version: Optional[int] = Query(default=None, description="Long-poll: wait until the character is newer than this version"),
+    timeout: float = Query(default=25, ge=0, le=LONG_POLL_MAX_SECONDS),
+):
     """Get current character information"""
     try:
-        character = chat_handler.get_current_character()
-        return character
+        return await versioned_response(chat_handler.character_state, request, version, timeout)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting character: {str(e)}")
 
 @app.get("/progress")
-async def get_transformation_progress():
+async def get_transformation_progress(
+    request: Request,
+    version: Optional[int] = Query(default=None, description="Long-poll: wait until progress is newer than this version"),
+    timeout: float = Query(default=25, ge=0, le=LONG_POLL_MAX_SECONDS),
+):
     """Get current transformation progress"""
     try:
-        progress = chat_handler.get_progress()
-        return progress
+        return await versioned_response(chat_handler.progress_state, request, version, timeout)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting progress: {str(e)}")
 
+@app.get("/metrics")
+async def get_metrics():
+    """Get runtime metrics"""
+    return {
+        "generation_budget": chat_handler.generation_budget.get_metrics(),
+        "storage": chat_handler.store.get_metrics(),
+        "event_loop": loop_monitor.get_metrics(),
+        "usage": chat_handler.usage.get_metrics()
+    }
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    """Guard admin endpoints with ADMIN_TOKEN; without one they don't exist"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def capture_profile(
+    mode: Literal["sampling", "cprofile"] = "sampling",
+    seconds: float = Query(default=10, gt=0, le=PROFILE_MAX_SECONDS),
+    request_count: int = Query(default=0, ge=0, alias="requests", description="Stop after this many requests finish (0 = run for `seconds`)"),
+):
+    """Capture a CPU profile of the event loop for the next N seconds or N requests"""
+    try:
+        profile = await profiler.capture(mode, seconds, request_count)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if mode == "cprofile":
+        return Response(content=profile, media_type="application/octet-stream",
+                        headers={"Content-Disposition": 'attachment; filename="sally.prof"'})
+    return Response(content=profile, media_type="text/plain",
+                    headers={"Content-Disposition": 'attachment; filename="sally.folded"'})
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -0,0 +1,200 @@
+import sys
+from array import array
+from datetime import datetime, timedelta
+from enum import Enum
+from itertools import compress
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from memory_stream import USER_ROLE, CHARACTER_ROLE
+
+USER_TURN_PREFIX = "User said: "
+CHARACTER_TURN_PREFIX = "Character replied: "
+# Texts up to this long are interned, so the "lol"s and "haha ok"s of thousands of sessions share one copy
+INTERN_MAX_CHARS = 64
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class Role(str, Enum):
+    """Whose memory file an entry lives in"""
+    USER = USER_ROLE
+    CHARACTER = CHARACTER_ROLE
+
+
+TURN_PREFIXES = {Role.USER: USER_TURN_PREFIX, Role.CHARACTER: CHARACTER_TURN_PREFIX}
+
+
+def parse_timestamp(key: str) -> Optional[int]:
+    """Microseconds since the epoch for an ISO memory key ("...Z" naive local time), or None"""
+    try:
+        return (datetime.fromisoformat(key[:-1] if key.endswith("Z") else key) - _EPOCH) // _MICROSECOND
+    except (ValueError, TypeError):
+        return None
+
+
+def format_timestamp(micros: int) -> str:
+    """ISO memory key for microseconds since the epoch, as add_memory writes them"""
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat() + "Z"
+
+
+class MemoryEntry:
+    """One memory, materialized from a MemoryLog row"""
+    __slots__ = ("micros", "role", "is_turn", "text")
+
+    def __init__(self, micros: int, role: Role, is_turn: bool, text: Any):
+        self.micros = micros
+        self.role = role
+        self.is_turn = is_turn
+        self.text = text
+
+    @property
+    def content(self) -> Any:
+        """The memory as stored in the file, turn prefix included"""
+        return TURN_PREFIXES[self.role] + self.text if self.is_turn else self.text
+
+
+class MemoryLog(Mapping):
+    """Column-backed memory document for one role of one session.
+
+    Rows are kept in insertion order as a timestamp column (array of int64
+    microseconds), a turn-flag column (bytearray) and a list of texts with
+    the "User said: "/"Character replied: " prefix stripped. Row positions
+    of turns and of other memories are indexed separately, so the newest N
+    of either are a slice away. Keys that don't round-trip through
+    `format_timestamp` are kept verbatim on the side.
+
+    Reads as a read-only mapping of ISO key -> content, like the JSON file.
+    """
+
+    def __init__(self, role: Role, document: Optional[Mapping[str, Any]] = None):
+        self.role = role
+        self._prefix = TURN_PREFIXES[role]
+        self._micros = array("q")
+        self._turn_flags = bytearray()
+        self._texts: List[Any] = []
+        self._turn_rows = array("l")
+        self._note_rows = array("l")
+        self._raw_keys: Dict[int, str] = {}
+        self._ordered = True
+        self._max_micros = -1
+        if document:
+            for key, value in document.items():
+                self[key] = value
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._key(row) for row in range(len(self._texts)))
+
+    def __getitem__(self, key: str) -> Any:
+        row = self._find(key)
+        if row is None:
+            raise KeyError(key)
+        return self._content(row)
+
+    def __setitem__(self, key: str, value: Any):
+        """Add or overwrite one memory (appends are O(1) while timestamps increase)"""
+        micros = parse_timestamp(key)
+        raw_key = None
+        if micros is None or format_timestamp(micros) != key:
+            raw_key = key
+        if micros is None:
+            # Unparseable keys sort where they were inserted
+            micros = self._micros[-1] if self._micros else 0
+
+        is_turn = isinstance(value, str) and value.startswith(self._prefix)
+        text = value[len(self._prefix):] if is_turn else value
+        if isinstance(text, str) and len(text) <= INTERN_MAX_CHARS:
+            text = sys.intern(text)
+
+        # A key newer than every row can't be an overwrite
+        row = self._find(key) if micros <= self._max_micros else None
+        if row is not None:
+            if bool(self._turn_flags[row]) != is_turn:
+                # Rare: rebuild the row indexes rather than patch them
+                self._turn_flags[row] = is_turn
+                self._reindex()
+            self._texts[row] = text
+            return
+
+        row = len(self._texts)
+        if self._micros and micros < self._micros[-1]:
+            self._ordered = False
+        self._max_micros = max(self._max_micros, micros)
+        self._micros.append(micros)
+        self._turn_flags.append(is_turn)
+        self._texts.append(text)
+        (self._turn_rows if is_turn else self._note_rows).append(row)
+        if raw_key is not None:
+            self._raw_keys[row] = raw_key
+
+    def _find(self, key: str) -> Optional[int]:
+        """Row holding `key`, searching from the newest row"""
+        micros = parse_timestamp(key)
+        for row in range(len(self._texts) - 1, -1, -1):
+            if self._ordered and micros is not None and self._micros[row] < micros:
+                return None
+            if self._key(row) == key:
+                return row
+        return None
+
+    def _reindex(self):
+        """Rebuild the turn/other row indexes from the flag column"""
+        self._turn_rows = array("l", compress(range(len(self._turn_flags)), self._turn_flags))
+        self._note_rows = array("l", (row for row, flag in enumerate(self._turn_flags) if not flag))
+
+    def _key(self, row: int) -> str:
+        raw_key = self._raw_keys.get(row)
+        return raw_key if raw_key is not None else format_timestamp(self._micros[row])
+
+    def _content(self, row: int) -> Any:
+        return self._prefix + self._texts[row] if self._turn_flags[row] else self._texts[row]
+
+    def _entry(self, row: int) -> MemoryEntry:
+        return MemoryEntry(self._micros[row], self.role, bool(self._turn_flags[row]), self._texts[row])
+
+    def newest(self, n: int, turns: Optional[bool] = None) -> List[MemoryEntry]:
+        """Last `n` entries in insertion order: all of them, only turns (True) or only other memories (False)"""
+        if n <= 0:
+            return []
+        if turns is None:
+            rows = range(max(0, len(self._texts) - n), len(self._texts))
+        else:
+            rows = (self._turn_rows if turns else self._note_rows)[-n:]
+        return [self._entry(row) for row in rows]
+
+    def turn_count(self) -> int:
+        """Number of conversation turns"""
+        return len(self._turn_rows)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return ((self._key(row), self._content(row)) for row in range(len(self._texts)))
+
+    def copy(self) -> "MemoryLog":
+        """Snapshot sharing the (immutable) texts"""
+        clone = MemoryLog.__new__(MemoryLog)
+        clone.role = self.role
+        clone._prefix = self._prefix
+        clone._micros = array("q", self._micros)
+        clone._turn_flags = bytearray(self._turn_flags)
+        clone._texts = list(self._texts)
+        clone._turn_rows = array("l", self._turn_rows)
+        clone._note_rows = array("l", self._note_rows)
+        clone._raw_keys = dict(self._raw_keys)
+        clone._ordered = self._ordered
+        clone._max_micros = self._max_micros
+        return clone
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The document as a plain dict, for writing it out"""
+        return dict(self.items())
+
+    def nbytes(self) -> int:
+        """Approximate resident size, counting each distinct text once"""
+        size = sys.getsizeof(self) + sys.getsizeof(self._texts) + sys.getsizeof(self._raw_keys)
+        for column in (self._micros, self._turn_flags, self._turn_rows, self._note_rows):
+            size += sys.getsizeof(column)
+        size += sum(sys.getsizeof(text) for text in {id(text): text for text in self._texts}.values())
+        return size + sum(sys.getsizeof(key) for key in self._raw_keys.values())
@@ -0,0 +1,149 @@
+import base64
+import heapq
+import json
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# Memory files are read in chunks of this size, so a listing only ever holds
+# one chunk plus the entry being decoded
+READ_CHUNK_SIZE = 64 * 1024
+
+# Role names for the two memory files of a session
+USER_ROLE = "user"
+CHARACTER_ROLE = "character"
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class MemoryFileError(ValueError):
+    """Raised when a memory file is not a JSON object of strings"""
+
+
+def iter_memory_file(file_path: str) -> Iterator[Tuple[str, Any]]:
+    """Yield (timestamp, memory) pairs from a memory file without loading it whole"""
+    try:
+        f = open(file_path, "r")
+    except FileNotFoundError:
+        return
+
+    with f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill() -> bool:
+            """Append the next chunk to the buffer, dropping what was consumed"""
+            nonlocal buffer, position, eof
+            if eof:
+                return False
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                eof = True
+                return False
+            buffer = buffer[position:] + chunk
+            position = 0
+            return True
+
+        def next_char() -> str:
+            """Skip whitespace and return the next significant character"""
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in _WHITESPACE:
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                if not fill():
+                    raise MemoryFileError(f"Unexpected end of {file_path}")
+
+        def decode_value() -> Any:
+            """Decode one JSON value, reading more of the file if it is cut off"""
+            nonlocal position
+            while True:
+                try:
+                    value, end = _decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if fill():
+                        continue
+                    raise MemoryFileError(f"Malformed memory file {file_path}")
+                # A value ending right at the buffer edge may be a truncated number
+                if end == len(buffer) and not eof and fill():
+                    continue
+                position = end
+                return value
+
+        try:
+            if next_char() != "{":
+                raise MemoryFileError(f"{file_path} is not a JSON object")
+        except MemoryFileError:
+            # Empty files hold no memories
+            if eof and not buffer.strip():
+                return
+            raise
+        position += 1
+
+        if next_char() == "}":
+            return
+        while True:
+            next_char()
+            key = decode_value()
+            if next_char() != ":":
+                raise MemoryFileError(f"Malformed memory file {file_path}")
+            position += 1
+            next_char()
+            yield key, decode_value()
+
+            separator = next_char()
+            position += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise MemoryFileError(f"Malformed memory file {file_path}")
+
+
+def encode_cursor(timestamp: str, role: str) -> str:
+    """Build an opaque cursor pointing just after an entry"""
+    return base64.urlsafe_b64encode(f"{timestamp}\n{role}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Parse a cursor made by encode_cursor"""
+    try:
+        timestamp, role = base64.urlsafe_b64decode(cursor.encode()).decode().split("\n", 1)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return timestamp, role
+
+
+def iter_memory_entries(user_memory_file: str, character_memory_file: str,
+                        role: Optional[str] = None, since: Optional[str] = None,
+                        until: Optional[str] = None, cursor: Optional[str] = None) -> Iterator[Dict[str, str]]:
+    """Merge a session's memory files into one time-ordered stream of entries.
+
+    `since` is inclusive and `until` exclusive; both compare against the ISO
+    timestamp keys, so a date prefix such as "2025-01-20" works. Entries are
+    ordered by (timestamp, role), which is also what `cursor` resumes from.
+    """
+    # Validate the cursor now rather than on the first read
+    after = decode_cursor(cursor) if cursor else None
+    return _merge_entries(user_memory_file, character_memory_file, role, since, until, after)
+
+
+def _merge_entries(user_memory_file: str, character_memory_file: str, role: Optional[str],
+                   since: Optional[str], until: Optional[str],
+                   after: Optional[Tuple[str, str]]) -> Iterator[Dict[str, str]]:
+    """Generator behind iter_memory_entries"""
+    sources = []
+    if role in (None, USER_ROLE):
+        sources.append(((timestamp, USER_ROLE, content) for timestamp, content in iter_memory_file(user_memory_file)))
+    if role in (None, CHARACTER_ROLE):
+        sources.append(((timestamp, CHARACTER_ROLE, content) for timestamp, content in iter_memory_file(character_memory_file)))
+
+    for timestamp, entry_role, content in heapq.merge(*sources, key=lambda entry: (entry[0], entry[1])):
+        if after and (timestamp, entry_role) <= after:
+            continue
+        if since and timestamp < since:
+            continue
+        if until and timestamp >= until:
+            # Entries are time ordered, nothing later can match
+            return
+        yield {"timestamp": timestamp, "role": entry_role, "content": content}
@@ -89,7 +89,7 @@ class ChatInterface {
             // Clear input and show transformation modal
             this.messageInput.value = '';
             this.updateSendButtonState();
-            this.showTransformationModal(changeText);
+            await this.showTransformationModal(changeText);
             
             this.isAwaitingResponse = true;
             this.updateSendButtonState();
@@ -294,7 +294,7 @@ class ChatInterface {
         this.closeChangeModal();
         
         // Show transformation modal instead of adding user message immediately
-        this.showTransformationModal(changeText);
+        await this.showTransformationModal(changeText);
         
         this.isAwaitingResponse = true;
         this.updateSendButtonState();
@@ -373,7 +373,7 @@ class ChatInterface {
         }
     }
 
-    showTransformationModal(changeText) {
+    async showTransformationModal(changeText) {
         console.log('🎭 Starting transformation modal...');
         
         // Store the change text for later use
@@ -405,8 +405,24 @@ class ChatInterface {
         // Show the modal
         document.getElementById('transformationModal').style.display = 'flex';
         
+        // Note the current progress version before the change is sent, so the
+        // finished progress of an earlier transformation isn't taken for this one
+        const baselineVersion = await this.fetchProgressVersion();
+        
         // Start the transformation animation - but don't reach 100% automatically
-        this.animateTransformationToAvatarGeneration();
+        this.animateTransformationToAvatarGeneration(baselineVersion);
+    }
+
+    async fetchProgressVersion() {
+        try {
+            const response = await fetch('/progress', { cache: 'no-store' });
+            if (response.ok) {
+                return response.headers.get('X-State-Version');
+            }
+        } catch (error) {
+            console.warn('Could not fetch progress version:', error);
+        }
+        return null;
     }
 
     extractCharacterNameFromChange(changeText) {
@@ -428,14 +444,30 @@ class ChatInterface {
         return 'New Character';
     }
 
-    async animateTransformationToAvatarGeneration() {
+    async animateTransformationToAvatarGeneration(baselineVersion) {
         console.log('🎬 Starting real-time progress tracking...');
         
-        // Poll for real progress from the backend
+        // Long-poll for real progress: each request returns as soon as the
+        // backend's progress version moves past the one we last saw, starting
+        // from the version current when the change was submitted
+        let version = baselineVersion || null;
+        let stopped = false;
+        
         const pollProgress = async () => {
             try {
-                const response = await fetch('/progress');
+                const url = version === null ? '/progress' : `/progress?version=${version}&timeout=25`;
+                const response = await fetch(url, { cache: 'no-store' });
                 if (response.ok) {
+                    const previousVersion = version;
+                    version = response.headers.get('X-State-Version') || version;
+                    if (previousVersion === null) {
+                        // No baseline: this is the state from before the change, only note its version
+                        return false;
+                    }
+                    if (version === previousVersion) {
+                        // Long-poll timed out without a change
+                        return false;
+                    }
                     const progressData = await response.json();
                     const { progress, status, character_name } = progressData;
                     
@@ -453,27 +485,27 @@ class ChatInterface {
                     return false; // Continue polling
                 } else {
                     console.warn('Failed to fetch progress, continuing to poll...');
+                    await new Promise(resolve => setTimeout(resolve, 500));
                     return false;
                 }
             } catch (error) {
                 console.warn('Progress polling error:', error);
+                await new Promise(resolve => setTimeout(resolve, 500));
                 return false; // Continue polling despite errors
             }
         };
         
-        // Poll every 500ms for smooth updates
-        const pollInterval = setInterval(async () => {
-            const isComplete = await pollProgress();
-            if (isComplete) {
-                clearInterval(pollInterval);
-            }
-        }, 500);
-        
         // Fallback: stop polling after 2 minutes to prevent infinite polling
         setTimeout(() => {
-            clearInterval(pollInterval);
+            stopped = true;
             console.log('🕐 Progress polling timeout - stopping');
         }, 120000);
+        
+        while (!stopped) {
+            if (await pollProgress()) {
+                break;
+            }
+        }
     }
 
     async updateTimelineProgress(progress, status) {
@@ -0,0 +1,424 @@
+import asyncio
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from logging_config import get_logger
+
+logger = get_logger("storage")
+
+# How long writes may sit in memory before a group commit
+STORAGE_FLUSH_INTERVAL_MS = float(os.getenv("STORAGE_FLUSH_INTERVAL_MS", "200"))
+# Pending writes that trigger a commit before the interval is up
+STORAGE_MAX_BATCH = int(os.getenv("STORAGE_MAX_BATCH", "256"))
+# "journal": fsync the journal once per batch (survives process crashes and,
+#            once the journal is on disk, power loss)
+# "all":     also fsync rewritten files and their directory before the journal is cleared
+# "off":     never fsync, leave it to the OS
+STORAGE_FSYNC = os.getenv("STORAGE_FSYNC", "journal")
+# Documents kept in memory; least recently used ones without unsaved writes are dropped beyond it (0: no limit)
+STORAGE_CACHE_MAX_DOCUMENTS = int(os.getenv("STORAGE_CACHE_MAX_DOCUMENTS", "1000"))
+
+# A write is (path, op, args): ("set", key, value) adds or overwrites one entry,
+# ("set_field", key, field, value) one field of a dict entry, ("replace", document)
+# swaps the whole document
+Op = Tuple[str, str, tuple]
+
+
+def _fsync_directory(directory: str):
+    """Persist renames inside a directory"""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(file_path: str, document: Dict[str, Any], fsync: bool = False):
+    """Write a JSON document next to its target and rename it into place"""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(document, f, indent=2)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def _plain(document: Any) -> Dict[str, Any]:
+    """A cached document as a JSON-serializable dict"""
+    return document if isinstance(document, dict) else document.to_dict()
+
+
+def _apply(document: Dict[str, Any], op: str, args: tuple) -> Dict[str, Any]:
+    """Apply one write to a document, returning the resulting document"""
+    if op == "set":
+        key, value = args
+        document[key] = value
+        return document
+    if op == "set_field":
+        key, field, value = args
+        entry = document.get(key)
+        # A new dict, since entries may be shared with commit snapshots
+        entry = dict(entry) if isinstance(entry, dict) else {}
+        entry[field] = value
+        document[key] = entry
+        return document
+    if op == "replace":
+        return dict(args[0])
+    raise ValueError(f"Unknown storage op: {op}")
+
+
+class WriteBehindStore:
+    """Caches JSON documents in memory and persists their writes in journaled group commits.
+
+    Writes update the cached document at once, so reads see them
+    immediately. A background task periodically journals all pending writes
+    as one line, rewrites each touched file via temp file + rename, then
+    clears the journal. Batches still in the journal at startup are
+    replayed onto the files. Beyond STORAGE_CACHE_MAX_DOCUMENTS, the least
+    recently used documents whose writes are all on disk are dropped and
+    reloaded when next read.
+    
+    In shared mode several processes write the same files: each keeps its
+    own journal, and commits re-read the files under a lock and merge their
+    writes in, instead of overwriting them with a cached copy. Each process
+    holds a lock on its journal while it runs, so only journals of processes
+    that are gone get recovered.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self.journal_path: Optional[str] = None
+        self.lock_path: Optional[str] = None
+        # Open handle whose flock marks our journal as owned by a live process (shared mode)
+        self._journal_lock = None
+        # Called with the paths of every successful commit
+        self.on_commit: Optional[Callable[[List[str]], None]] = None
+        # Turns a document loaded from disk into its cached form (e.g. a compact MemoryLog);
+        # cached forms must support item assignment, copy() and to_dict()
+        self.compact: Optional[Callable[[str, Dict[str, Any]], Any]] = None
+        self._documents: "OrderedDict[str, Any]" = OrderedDict()
+        self._pending: List[Op] = []
+        self._failed_paths: set = set()
+        # Documents that can't be written at all and only live in memory
+        self._memory_only_paths: set = set()
+        # Paths of the batch being committed
+        self._committing_paths: set = set()
+        self._evictions = 0
+        self._flush_lock = asyncio.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batches = 0
+
+    def open(self, directory: str):
+        """Use a journal in `directory`, replaying any batches left from a crash"""
+        journal_name = f"journal-{os.getpid()}-{uuid.uuid4().hex[:6]}.log" if self.shared else "journal.log"
+        self.journal_path = os.path.join(directory, journal_name)
+        self.lock_path = os.path.join(directory, "store.lock")
+        self._documents.clear()
+        with self._file_lock():
+            if self.shared:
+                # Taken under the store lock, so no peer can recover the journal before we own it
+                if self._journal_lock is not None:
+                    self._journal_lock.close()
+                self._journal_lock = open(self.journal_path, "a")
+                fcntl.flock(self._journal_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.recover(directory)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Serialize file commits across processes (no-op unless shared)"""
+        if not self.shared or not self.lock_path:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def recover(self, directory: str):
+        """Replay journaled batches onto their files and clear the journals.
+
+        In shared mode, journals still locked by a running process are left alone.
+        """
+        journals = []
+        owner_locks = []
+        for journal_path in glob.glob(os.path.join(directory, "journal*.log")):
+            if self.shared:
+                if journal_path == self.journal_path:
+                    continue
+                lock_file = open(journal_path, "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+                owner_locks.append(lock_file)
+            journals.append(journal_path)
+        try:
+            self._replay(sorted(journals, key=os.path.getmtime))
+        finally:
+            for lock_file in owner_locks:
+                lock_file.close()
+
+    def _replay(self, journals: List[str]):
+        """Apply the batches in `journals` to their files, then delete the journals"""
+        if not journals:
+            return
+
+        documents: Dict[str, Dict[str, Any]] = {}
+        replayed = 0
+        for journal_path in journals:
+            with open(journal_path, "r") as f:
+                for line in f:
+                    try:
+                        batch = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line is a batch that was never acknowledged
+                        logger.warning("Discarding incomplete journal batch", extra={"path": journal_path})
+                        break
+                    for path, op, args in batch["ops"]:
+                        if path not in documents:
+                            documents[path] = self._load_from_disk(path)
+                        documents[path] = _apply(documents[path], op, tuple(args))
+                    replayed += 1
+
+        for path, document in documents.items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            write_json_atomic(path, document, fsync=STORAGE_FSYNC != "off")
+        if STORAGE_FSYNC != "off":
+            for directory in {os.path.dirname(path) for path in documents}:
+                _fsync_directory(directory)
+        for journal_path in journals:
+            os.remove(journal_path)
+        if replayed:
+            logger.info("Replayed journaled writes", extra={"batches": replayed, "files": len(documents)})
+
+    def _load_from_disk(self, file_path: str) -> Dict[str, Any]:
+        """Read a JSON document, treating missing or unreadable files as empty"""
+        try:
+            with open(file_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, PermissionError) as e:
+            logger.warning("Could not load %s: %s", file_path, e)
+            return {}
+
+    def _cache(self, file_path: str, document: Dict[str, Any]) -> Any:
+        """Keep a document in memory in its cached form"""
+        if self.compact is not None:
+            document = self.compact(file_path, document)
+        self._documents[file_path] = document
+        self._documents.move_to_end(file_path)
+        if STORAGE_CACHE_MAX_DOCUMENTS > 0 and len(self._documents) > STORAGE_CACHE_MAX_DOCUMENTS:
+            self._evict(file_path)
+        return document
+
+    def _evict(self, keep: Optional[str] = None):
+        """Drop least recently used documents down to the cache limit, keeping `keep` and any with unsaved writes"""
+        dirty = {path for path, _, _ in self._pending} | self._failed_paths | self._committing_paths
+        dirty |= self._memory_only_paths
+        dirty.add(keep)
+        excess = len(self._documents) - STORAGE_CACHE_MAX_DOCUMENTS
+        for path in [path for path in self._documents if path not in dirty][:excess]:
+            del self._documents[path]
+            self._evictions += 1
+
+    def read(self, file_path: str) -> Any:
+        """Get the current document, including writes not yet on disk; treat it as read-only"""
+        document = self._documents.get(file_path)
+        if document is None:
+            document = self._cache(file_path, self._load_from_disk(file_path))
+        else:
+            self._documents.move_to_end(file_path)
+        return document
+
+    def documents(self) -> Dict[str, Any]:
+        """Cached documents by path; treat them as read-only"""
+        return dict(self._documents)
+
+    def set(self, file_path: str, key: str, value: Any):
+        """Add or overwrite one entry of a document"""
+        self.read(file_path)[key] = value
+        self._enqueue((file_path, "set", (key, value)))
+
+    def set_field(self, file_path: str, key: str, field: str, value: Any):
+        """Add or overwrite one field of an entry; in shared mode other processes' fields are kept"""
+        _apply(self.read(file_path), "set_field", (key, field, value))
+        self._enqueue((file_path, "set_field", (key, field, value)))
+
+    def replace(self, file_path: str, document: Dict[str, Any]):
+        """Swap a whole document"""
+        document = _plain(document)
+        self._cache(file_path, dict(document))
+        self._enqueue((file_path, "replace", (dict(document),)))
+
+    def _enqueue(self, op: Op):
+        """Queue a write for the next group commit"""
+        self._pending.append(op)
+        if self._wakeup is not None and len(self._pending) >= STORAGE_MAX_BATCH:
+            self._wakeup.set()
+
+    def invalidate(self, paths: List[str]):
+        """Drop cached documents another process changed, unless we have writes queued for them"""
+        pending_paths = {path for path, _, _ in self._pending}
+        for path in paths:
+            if path not in pending_paths:
+                self._documents.pop(path, None)
+
+    def _commit(self, ops: List[Op], snapshots: Dict[str, Any]) -> Tuple[List[str], List[str], Dict[str, Dict[str, Any]]]:
+        """Journal a batch, rewrite its files and clear the journal.
+        
+        Returns the paths that failed, those kept in memory only and the documents as written.
+        """
+        with self._io_lock, self._file_lock():
+            if self.journal_path and ops:
+                try:
+                    line = json.dumps({"ops": ops}) + "\n"
+                    with open(self.journal_path, "a") as journal:
+                        journal.write(line)
+                        if STORAGE_FSYNC != "off":
+                            journal.flush()
+                            os.fsync(journal.fileno())
+                except Exception as e:
+                    # Still write the files; only crash recovery for this batch is lost
+                    logger.error("Could not journal batch: %s", e)
+
+            if self.shared:
+                # Apply our writes on top of whatever the other processes committed
+                documents: Dict[str, Dict[str, Any]] = {}
+                for path, op, args in ops:
+                    if path not in documents:
+                        documents[path] = self._load_from_disk(path)
+                    documents[path] = _apply(documents[path], op, args)
+            else:
+                documents = snapshots
+
+            failed, memory_only = [], []
+            for path, document in documents.items():
+                try:
+                    write_json_atomic(path, _plain(document), fsync=STORAGE_FSYNC == "all")
+                except (PermissionError, FileNotFoundError) as e:
+                    # Same as before write-behind: the data stays in memory only
+                    logger.warning("Could not save %s, keeping it in memory only: %s", path, e)
+                    memory_only.append(path)
+                except Exception as e:
+                    logger.error("Error saving %s: %s", path, e)
+                    failed.append(path)
+
+            if STORAGE_FSYNC == "all":
+                for directory in {os.path.dirname(path) for path in documents}:
+                    _fsync_directory(directory)
+
+            # Keep the journal while any file is behind so a restart can redo it
+            if self.journal_path and not failed and os.path.exists(self.journal_path):
+                os.truncate(self.journal_path, 0)
+            return failed, memory_only, documents
+
+    async def flush(self):
+        """Group-commit every pending write"""
+        async with self._flush_lock:
+            if not self._pending and not self._failed_paths:
+                return
+            ops, self._pending = self._pending, []
+            self._committing_paths = {path for path, _, _ in ops} | self._failed_paths
+            snapshots = {}
+            if not self.shared:
+                paths = self._committing_paths
+                self._failed_paths = set()
+                # Shallow copies are enough: entries are immutable strings or replaced wholesale
+                snapshots = {path: self.read(path).copy() for path in paths}
+
+            try:
+                failed, memory_only, committed = await asyncio.to_thread(self._commit, ops, snapshots)
+            except BaseException:
+                # Keep the batch for the next commit rather than lose it
+                self._pending = ops + self._pending
+                if not self.shared:
+                    self._failed_paths.update(snapshots)
+                raise
+            finally:
+                self._committing_paths = set()
+            self._batches += 1
+            self._memory_only_paths.update(memory_only)
+            self._memory_only_paths.difference_update(path for path in committed
+                                                      if path not in failed and path not in memory_only)
+
+            if self.shared:
+                # Retry failed writes ahead of newer ones
+                self._pending = [op for op in ops if op[0] in failed] + self._pending
+                for path, document in committed.items():
+                    if path in failed:
+                        continue
+                    # Disk now has other processes' writes too; layer on ours that arrived meanwhile
+                    for pending_path, op, args in self._pending:
+                        if pending_path == path:
+                            document = _apply(document, op, args)
+                    self._cache(path, document)
+            else:
+                self._failed_paths.update(failed)
+
+            if STORAGE_CACHE_MAX_DOCUMENTS > 0 and len(self._documents) > STORAGE_CACHE_MAX_DOCUMENTS:
+                # Documents that were over the limit only because of unsaved writes can go now
+                self._evict()
+
+            if self.on_commit is not None:
+                self.on_commit([path for path in committed if path not in failed])
+
+    async def run(self):
+        """Commit pending writes every flush interval, or sooner when a batch fills up"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=STORAGE_FLUSH_INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Group commit failed: %s", e)
+
+    def start(self):
+        """Start the background flusher"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def drain(self):
+        """Stop the flusher and persist everything still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        await self.flush()
+        logger.info("Storage drained", extra={"batches": self._batches})
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Snapshot of write-behind state"""
+        return {
+            "pending_writes": len(self._pending),
+            "cached_documents": len(self._documents),
+            "cache_evictions": self._evictions,
+            "group_commits": self._batches,
+            "fsync": STORAGE_FSYNC,
+        }
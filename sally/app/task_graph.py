@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from logging_config import get_logger
+
+logger = get_logger("task_graph")
+
+# A task gets the results of the tasks it depends on, by name; it may be sync or async
+TaskFunc = Callable[[Dict[str, Any]], Any]
+
+
+class TaskGraph:
+    """Runs async tasks as soon as the tasks they depend on have finished.
+
+    Independent tasks run concurrently. If any task fails, the tasks still
+    running are cancelled and the error is raised from `run`.
+    """
+
+    def __init__(self):
+        self._funcs: Dict[str, TaskFunc] = {}
+        self._deps: Dict[str, List[str]] = {}
+        self._weights: Dict[str, float] = {}
+        # Seconds each task took in the last run
+        self.timings: Dict[str, float] = {}
+
+    def add(self, name: str, func: TaskFunc, deps: Iterable[str] = (), weight: float = 1.0):
+        """Add a task; `weight` is its expected share of the work, for progress reporting"""
+        deps = list(deps)
+        for dep in deps:
+            if dep not in self._funcs:
+                raise ValueError(f"Task {name!r} depends on unknown task {dep!r}")
+        self._funcs[name] = func
+        self._deps[name] = deps
+        self._weights[name] = weight
+
+    async def run(self, on_progress: Optional[Callable[[float, str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Run every task and return their results by name.
+
+        `on_progress(fraction, name, results)` is called as each task
+        finishes, with the weighted fraction of the graph done so far.
+        """
+        results: Dict[str, Any] = {}
+        tasks: Dict[str, asyncio.Task] = {}
+        total_weight = sum(self._weights.values()) or 1.0
+        done_weight = 0.0
+        self.timings = {}
+
+        async def run_task(name: str) -> Any:
+            nonlocal done_weight
+            if self._deps[name]:
+                await asyncio.gather(*(tasks[dep] for dep in self._deps[name]))
+            started = time.perf_counter()
+            result = self._funcs[name]({dep: results[dep] for dep in self._deps[name]})
+            if inspect.isawaitable(result):
+                result = await result
+            self.timings[name] = time.perf_counter() - started
+            results[name] = result
+            done_weight += self._weights[name]
+            if on_progress is not None:
+                try:
+                    on_progress(done_weight / total_weight, name, results)
+                except Exception as e:
+                    logger.error("Progress callback failed: %s", e)
+            return result
+
+        # Tasks were added after their dependencies, so this creates them in a valid order
+        for name in self._funcs:
+            tasks[name] = asyncio.create_task(run_task(name), name=name)
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return results
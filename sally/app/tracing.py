@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import uuid
+from typing import Optional
+
+from logging_config import get_logger
+
+logger = get_logger("tracing")
+
+# JSONL file that anonymized /chat traces are appended to (unset disables capture)
+TRACE_CAPTURE_FILE = os.getenv("TRACE_CAPTURE_FILE", "")
+# Salt for hashing session ids; unset, one is generated and kept next to the trace file
+TRACE_SALT = os.getenv("TRACE_SALT", "")
+
+# Salt for traces not tied to a capture file (e.g. rebuilt from memory files in one run)
+_process_salt = TRACE_SALT or uuid.uuid4().hex
+
+
+def load_salt(trace_path: str) -> str:
+    """The salt kept in `<trace_path>.salt`, created on first use.
+
+    Every worker, and every restart, hashes a session to the same id as
+    long as they write to the same trace file.
+    """
+    salt_path = f"{trace_path}.salt"
+    if not os.path.exists(salt_path):
+        tmp_path = f"{salt_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(uuid.uuid4().hex)
+        try:
+            # Links atomically, and fails if another worker got there first
+            os.link(tmp_path, salt_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(salt_path, "r") as f:
+        return f.read().strip()
+
+
+def anonymize_session(session_id: Optional[str], salt: Optional[str] = None) -> str:
+    """Stable, non-reversible stand-in for a session id"""
+    return hashlib.sha256(f"{salt or _process_salt}:{session_id or 'default'}".encode()).hexdigest()[:16]
+
+
+def describe_message(message: str) -> dict:
+    """Shape of a message without its content"""
+    kind = "change" if message.strip().lower().startswith("/change") else "chat"
+    return {"kind": kind, "message_chars": len(message), "message_words": len(message.split())}
+
+
+class TraceRecorder:
+    """Appends one anonymized record per chat turn (/chat and /chat/batch) to a JSONL file from a background thread"""
+
+    def __init__(self, path: str = TRACE_CAPTURE_FILE):
+        self.path = path
+        self.salt: Optional[str] = None
+        self._queue: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        if path:
+            try:
+                self.salt = TRACE_SALT or load_salt(path)
+            except OSError as e:
+                logger.error("Trace capture disabled, could not set up a salt for %s: %s", path, e)
+                return
+            self._thread = threading.Thread(target=self._write, name="trace-writer", daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether traces are being captured"""
+        return self._thread is not None
+
+    def record(self, session_id: Optional[str], message: str, started: float, duration: float, status: int):
+        """Queue a trace record for a finished turn"""
+        if not self.enabled:
+            return
+        entry = {
+            "t": round(started, 3),
+            "session": anonymize_session(session_id, self.salt),
+            **describe_message(message),
+            "duration_ms": round(duration * 1000, 1),
+            "status": status,
+        }
+        self._queue.put(json.dumps(entry))
+
+    def _write(self):
+        """Writer thread: batch queued records into appends"""
+        while True:
+            line = self._queue.get()
+            if line is None:
+                return
+            lines = [line]
+            while True:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    self._queue.put(None)
+                    break
+                lines.append(more)
+            try:
+                with open(self.path, "a") as f:
+                    f.write("\n".join(lines) + "\n")
+            except Exception as e:
+                logger.error("Could not write traces to %s: %s", self.path, e)
+
+    def close(self):
+        """Flush queued records and stop the writer"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,270 @@
+import asyncio
+import fcntl
+import itertools
+import json
+import math
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from logging_config import get_logger
+from generation_budget import FAST_MODEL
+
+logger = get_logger("usage")
+
+# Tokens a session may use per budget window (0 disables budgets; usage is still recorded)
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))
+# Length of a session's budget window
+USAGE_BUDGET_WINDOW_SECONDS = float(os.getenv("USAGE_BUDGET_WINDOW_SECONDS", "86400"))
+# Share of the budget after which a session's replies are downgraded
+USAGE_DOWNGRADE_FRACTION = float(os.getenv("USAGE_DOWNGRADE_FRACTION", "0.8"))
+# Cheaper model for downgraded sessions (defaults to FAST_MODEL; unset keeps the model)
+BUDGET_MODEL = os.getenv("BUDGET_MODEL", "") or FAST_MODEL
+# Reply token cap for downgraded sessions
+BUDGET_MAX_TOKENS = int(os.getenv("BUDGET_MAX_TOKENS", "40"))
+# Once over budget, a session gets at most one turn per this many seconds
+USAGE_THROTTLE_SECONDS = float(os.getenv("USAGE_THROTTLE_SECONDS", "30"))
+# How often aggregated usage is folded into the store
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "10"))
+# Prices for cost estimates: USD per million tokens by model (JSON), and USD per generated image
+MODEL_PRICES_JSON = os.getenv("MODEL_PRICES", "")
+IMAGE_PRICE = float(os.getenv("IMAGE_PRICE", "0"))
+
+
+def _load_prices(raw: str) -> Dict[str, float]:
+    """Parse MODEL_PRICES, ignoring it if malformed"""
+    if not raw:
+        return {}
+    try:
+        return {model: float(price) for model, price in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning("Ignoring malformed MODEL_PRICES: %s", e)
+        return {}
+
+
+MODEL_PRICES = _load_prices(MODEL_PRICES_JSON)
+
+# Counters kept per (session, call type, model): calls, prompt tokens, completion tokens, images
+CALLS, PROMPT_TOKENS, COMPLETION_TOKENS, IMAGES = range(4)
+
+
+class UsageThrottledError(RuntimeError):
+    """Raised when an over-budget session sends turns faster than the throttle allows"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SessionWindow:
+    """A session's spend in its current budget window"""
+    __slots__ = ("started", "tokens", "others", "last_turn")
+
+    def __init__(self, started: float, tokens: int = 0):
+        self.started = started
+        self.tokens = tokens
+        # Part of `tokens` spent by other workers, as of when the window was resumed
+        self.others = 0
+        self.last_turn = 0.0
+
+
+class UsageTracker:
+    """Per-session token and image accounting with budget enforcement.
+
+    Usage returned by the API is aggregated in memory per (session, call
+    type, model) and folded into a usage document in the write-behind store
+    every USAGE_FLUSH_INTERVAL_SECONDS. Each session's entry holds one
+    field per worker slot, which only the worker holding that slot writes,
+    so workers sharing the document never overwrite each other's counts.
+    Slots are reused by later workers, so the fields stay bounded by the
+    most workers ever run at once. A session's token spend
+    in its current window decides whether its replies are downgraded to a
+    smaller budget and cheaper model, or its turns throttled.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # Usage document, set by `open` once the memory directory is known
+        self.path: Optional[str] = None
+        # Field of each session entry this process writes
+        self.worker = "main"
+        # Open handle whose flock holds our worker slot (shared mode)
+        self._slot_lock = None
+        self._pending: Dict[Tuple[str, str, str], List[int]] = {}
+        self._windows: Dict[str, SessionWindow] = {}
+        self._totals: Dict[Tuple[str, str], List[int]] = {}
+        self._metrics = {"downgrades": 0, "throttled": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def open(self, path: str):
+        """Keep usage in `path`; in shared mode, claim a worker slot next to it"""
+        self.path = path
+        if self.store.shared:
+            self.worker = self._claim_slot(os.path.dirname(path))
+
+    def _claim_slot(self, directory: str) -> str:
+        """Lowest worker slot no live process holds; held until this process exits"""
+        if self._slot_lock is not None:
+            self._slot_lock.close()
+        for slot in itertools.count():
+            lock_file = open(os.path.join(directory, f"usage-worker-{slot}.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self._slot_lock = lock_file
+            return f"worker-{slot}"
+
+    def _window(self, session: str) -> SessionWindow:
+        """The session's current window, resumed from the usage document after a restart"""
+        now = time.time()
+        window = self._windows.get(session)
+        if window is None:
+            saved = self.store.read(self.path).get(session, {}) if self.path else {}
+            window = self._windows[session] = SessionWindow(now)
+            # Add up every worker's spend in windows still open
+            for worker, entry in saved.items():
+                started = entry.get("window_started", now)
+                if now - started >= USAGE_BUDGET_WINDOW_SECONDS:
+                    continue
+                window.started = min(window.started, started)
+                window.tokens += entry.get("window_tokens", 0)
+                if worker != self.worker:
+                    window.others += entry.get("window_tokens", 0)
+        if now - window.started >= USAGE_BUDGET_WINDOW_SECONDS:
+            window.started, window.tokens, window.others = now, 0, 0
+        return window
+
+    def record(self, session: str, call_type: str, model: str, usage: Any = None, images: int = 0):
+        """Account one upstream call; `usage` is the API's usage object, if it returned one"""
+        prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+        completion_tokens = int(getattr(usage, "completion_tokens", 0) or 0)
+        for counters in (self._pending.setdefault((session, call_type, model), [0, 0, 0, 0]),
+                         self._totals.setdefault((call_type, model), [0, 0, 0, 0])):
+            counters[CALLS] += 1
+            counters[PROMPT_TOKENS] += prompt_tokens
+            counters[COMPLETION_TOKENS] += completion_tokens
+            counters[IMAGES] += images
+        self._window(session).tokens += prompt_tokens + completion_tokens
+
+    def check(self, session: str):
+        """Admit a turn, or raise UsageThrottledError if an over-budget session is going too fast"""
+        if SESSION_TOKEN_BUDGET <= 0:
+            return
+        window = self._window(session)
+        now = time.time()
+        if window.tokens >= SESSION_TOKEN_BUDGET:
+            wait = USAGE_THROTTLE_SECONDS - (now - window.last_turn)
+            if wait > 0:
+                self._metrics["throttled"] += 1
+                raise UsageThrottledError(f"Session {session!r} is over its token budget", math.ceil(wait))
+        window.last_turn = now
+
+    def limit(self, session: str, decision: Dict[str, Any]) -> Dict[str, Any]:
+        """Downgrade a generation decision (model, max_tokens) for sessions close to their budget"""
+        if SESSION_TOKEN_BUDGET <= 0 or self._window(session).tokens < SESSION_TOKEN_BUDGET * USAGE_DOWNGRADE_FRACTION:
+            return decision
+        downgraded = dict(decision, max_tokens=min(decision["max_tokens"], BUDGET_MAX_TOKENS), reason="session_budget")
+        if BUDGET_MODEL:
+            downgraded["model"] = BUDGET_MODEL
+        self._metrics["downgrades"] += 1
+        logger.debug("Session downgraded for token budget", extra={"session": session, **downgraded, "sampled": True})
+        return downgraded
+
+    def flush(self):
+        """Fold usage since the last flush into the usage document"""
+        if not self.path or not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        document = self.store.read(self.path)
+
+        by_session: Dict[str, List[Tuple[str, str, List[int]]]] = {}
+        for (session, call_type, model), counters in pending.items():
+            by_session.setdefault(session, []).append((call_type, model, counters))
+
+        for session, rows in by_session.items():
+            saved = document.get(session, {}).get(self.worker, {})
+            # Build new dicts: stored entries must never change in place (commits snapshot shallowly)
+            calls = {call_type: dict(models) for call_type, models in saved.get("calls", {}).items()}
+            for call_type, model, counters in rows:
+                previous = calls.setdefault(call_type, {}).get(model, {})
+                calls[call_type][model] = {
+                    "calls": previous.get("calls", 0) + counters[CALLS],
+                    "prompt_tokens": previous.get("prompt_tokens", 0) + counters[PROMPT_TOKENS],
+                    "completion_tokens": previous.get("completion_tokens", 0) + counters[COMPLETION_TOKENS],
+                    "images": previous.get("images", 0) + counters[IMAGES],
+                }
+            window = self._window(session)
+            self.store.set_field(self.path, session, self.worker, {
+                "calls": calls,
+                "window_started": window.started,
+                "window_tokens": window.tokens - window.others,
+                "updated": datetime.now().isoformat() + "Z",
+            })
+
+        # Expired windows restart at zero anyway; don't keep idle sessions around
+        now = time.time()
+        for session in [session for session, window in self._windows.items()
+                        if now - window.started >= USAGE_BUDGET_WINDOW_SECONDS]:
+            del self._windows[session]
+
+    async def run(self):
+        """Flush aggregated usage periodically"""
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Usage flush failed: %s", e)
+
+    def start(self):
+        """Start the periodic flush"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop flushing and hand the remaining usage to the store"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Usage since startup by call type and model, estimated cost and budget state"""
+        by_call_type: Dict[str, Dict[str, Any]] = {}
+        total_cost = 0.0
+        for (call_type, model), counters in self._totals.items():
+            tokens = counters[PROMPT_TOKENS] + counters[COMPLETION_TOKENS]
+            cost = tokens * MODEL_PRICES.get(model, 0.0) / 1_000_000 + counters[IMAGES] * IMAGE_PRICE
+            total_cost += cost
+            by_call_type.setdefault(call_type, {})[model] = {
+                "calls": counters[CALLS],
+                "prompt_tokens": counters[PROMPT_TOKENS],
+                "completion_tokens": counters[COMPLETION_TOKENS],
+                "images": counters[IMAGES],
+                "estimated_cost_usd": round(cost, 6),
+            }
+
+        now = time.time()
+        windows = {session: window for session, window in self._windows.items()
+                   if now - window.started < USAGE_BUDGET_WINDOW_SECONDS}
+        heaviest = sorted(windows.items(), key=lambda item: item[1].tokens, reverse=True)[:10]
+        budget = SESSION_TOKEN_BUDGET
+        return {
+            "session_token_budget": budget,
+            "window_seconds": USAGE_BUDGET_WINDOW_SECONDS,
+            "by_call_type": by_call_type,
+            "estimated_cost_usd": round(total_cost, 6),
+            "sessions_tracked": len(windows),
+            "sessions_downgraded": sum(1 for window in windows.values()
+                                       if budget > 0 and window.tokens >= budget * USAGE_DOWNGRADE_FRACTION),
+            "sessions_over_budget": sum(1 for window in windows.values() if budget > 0 and window.tokens >= budget),
+            "heaviest_sessions": {session: window.tokens for session, window in heaviest},
+            **self._metrics,
+        }
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+from typing import Any, Callable, Optional
+
+
+class VersionedState:
+    """Version counter and cached JSON body for a piece of state clients poll.
+
+    Versions are milliseconds since the epoch, bumped by at least one per
+    change, so they keep increasing across restarts. A change applied from
+    another worker adopts the version that worker gave it, so every worker
+    serves the same version (and ETag) for the same state. Waiters are
+    woken on every bump.
+    """
+
+    def __init__(self, render: Callable[[], Any]):
+        self._render = render
+        self.version = int(time.time() * 1000)
+        self._body: Optional[bytes] = None
+        self._changed = asyncio.Event()
+
+    def bump(self, version: Optional[int] = None):
+        """Record that the state changed and wake everyone waiting on it; `version` adopts one assigned elsewhere"""
+        self.version = version if version is not None else max(self.version + 1, int(time.time() * 1000))
+        self._body = None
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def etag(self) -> str:
+        """Entity tag of the current version"""
+        return f'"{self.version}"'
+
+    def body(self) -> bytes:
+        """The state serialized as JSON, rendered once per version"""
+        if self._body is None:
+            self._body = json.dumps(self._render()).encode()
+        return self._body
+
+    async def wait_newer(self, version: int, timeout: float) -> bool:
+        """Wait until the state is newer than `version`; False if `timeout` runs out first"""
+        deadline = time.monotonic() + timeout
+        while self.version <= version:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+import memory_stream
+from memory_stream import (CHARACTER_ROLE, USER_ROLE, MemoryFileError, decode_cursor, encode_cursor,
+                           iter_memory_entries, iter_memory_file)
+
+
+def write(path, document):
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+    return str(path)
+
+
+@pytest.fixture
+def memory_files(tmp_path):
+    user = write(tmp_path / "user.json", {
+        "2025-01-20T10:00:00Z": "User said: hi",
+        "2025-01-20T10:00:02Z": "User said: how are you?",
+        "2025-01-21T09:00:00Z": "User said: morning",
+    })
+    character = write(tmp_path / "sally.json", {
+        "2025-01-20T10:00:00Z": "Character replied: hey!",
+        "2025-01-20T10:00:03Z": "Character replied: good, you?",
+        "2025-01-21T09:00:01Z": "Character replied: morning :)",
+    })
+    return user, character
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("2025-01-20T10:00:00.123456Z", CHARACTER_ROLE)
+    assert decode_cursor(cursor) == ("2025-01-20T10:00:00.123456Z", CHARACTER_ROLE)
+
+
+def test_invalid_cursor_is_rejected_up_front(memory_files):
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor!")
+    with pytest.raises(ValueError):
+        iter_memory_entries(*memory_files, cursor="not a cursor!")
+
+
+def test_entries_are_merged_in_time_order(memory_files):
+    entries = list(iter_memory_entries(*memory_files))
+
+    assert [(entry["timestamp"], entry["role"]) for entry in entries] == [
+        ("2025-01-20T10:00:00Z", CHARACTER_ROLE),
+        ("2025-01-20T10:00:00Z", USER_ROLE),
+        ("2025-01-20T10:00:02Z", USER_ROLE),
+        ("2025-01-20T10:00:03Z", CHARACTER_ROLE),
+        ("2025-01-21T09:00:00Z", USER_ROLE),
+        ("2025-01-21T09:00:01Z", CHARACTER_ROLE),
+    ]
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 4])
+def test_paging_with_cursors_returns_every_entry_once(memory_files, page_size):
+    everything = list(iter_memory_entries(*memory_files))
+
+    pages, cursor = [], None
+    while True:
+        page = []
+        for entry in iter_memory_entries(*memory_files, cursor=cursor):
+            page.append(entry)
+            if len(page) == page_size:
+                break
+        if not page:
+            break
+        pages.extend(page)
+        cursor = encode_cursor(page[-1]["timestamp"], page[-1]["role"])
+
+    assert pages == everything
+
+
+def test_role_and_time_filters(memory_files):
+    entries = list(iter_memory_entries(*memory_files, role=USER_ROLE, since="2025-01-20T10:00:01", until="2025-01-21"))
+    assert [entry["content"] for entry in entries] == ["User said: how are you?"]
+
+
+def test_file_is_read_across_chunk_boundaries(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_stream, "READ_CHUNK_SIZE", 7)
+    document = {f"2025-01-20T10:00:{i:02d}Z": f"memory {i} " + "x" * i for i in range(30)}
+    document["2025-01-20T11:00:00Z"] = 12345
+    path = write(tmp_path / "user.json", document)
+
+    assert dict(iter_memory_file(path)) == document
+
+
+def test_missing_and_empty_files_hold_no_memories(tmp_path):
+    empty = tmp_path / "empty.json"
+    empty.write_text("")
+    assert list(iter_memory_file(str(tmp_path / "missing.json"))) == []
+    assert list(iter_memory_file(str(empty))) == []
+
+
+def test_malformed_file_raises(tmp_path):
+    path = tmp_path / "user.json"
+    path.write_text('{"a": "b" "c": "d"}')
+    with pytest.raises(MemoryFileError):
+        list(iter_memory_file(str(path)))
@@ -0,0 +1,210 @@
+import asyncio
+import fcntl
+import json
+import os
+
+import pytest
+
+import storage
+from storage import WriteBehindStore
+
+
+def write_journal(path, *lines):
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def cache_limit(monkeypatch):
+    def set_limit(limit):
+        monkeypatch.setattr(storage, "STORAGE_CACHE_MAX_DOCUMENTS", limit)
+    return set_limit
+
+
+def test_open_replays_journal_onto_files(tmp_path):
+    doc = str(tmp_path / "user.json")
+    with open(doc, "w") as f:
+        json.dump({"a": 1}, f)
+    write_journal(tmp_path / "journal.log",
+                  json.dumps({"ops": [[doc, "set", ["b", 2]]]}),
+                  json.dumps({"ops": [[doc, "set", ["a", 3]], [doc, "set_field", ["c", "x", 4]]]}))
+
+    store = WriteBehindStore()
+    store.open(str(tmp_path))
+
+    assert load(doc) == {"a": 3, "b": 2, "c": {"x": 4}}
+    assert not os.path.exists(tmp_path / "journal.log")
+
+
+def test_open_discards_torn_last_batch(tmp_path):
+    doc = str(tmp_path / "user.json")
+    write_journal(tmp_path / "journal.log",
+                  json.dumps({"ops": [[doc, "set", ["a", 1]]]}),
+                  json.dumps({"ops": [[doc, "set", ["b", 2]]]})[:-5])
+
+    WriteBehindStore().open(str(tmp_path))
+
+    assert load(doc) == {"a": 1}
+
+
+def test_shared_open_leaves_live_workers_journals_alone(tmp_path):
+    doc = str(tmp_path / "user.json")
+    live_journal = tmp_path / "journal-1-aaaaaa.log"
+    dead_journal = tmp_path / "journal-2-bbbbbb.log"
+    write_journal(live_journal, json.dumps({"ops": [[doc, "set", ["live", 1]]]}))
+    write_journal(dead_journal, json.dumps({"ops": [[doc, "set", ["dead", 2]]]}))
+
+    with open(live_journal, "a") as owner:
+        fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        WriteBehindStore(shared=True).open(str(tmp_path))
+
+    assert load(doc) == {"dead": 2}
+    assert os.path.exists(live_journal)
+    assert not os.path.exists(dead_journal)
+
+
+def test_shared_store_locks_its_own_journal(tmp_path):
+    store = WriteBehindStore(shared=True)
+    store.open(str(tmp_path))
+    peer = WriteBehindStore(shared=True)
+    peer.open(str(tmp_path))
+
+    assert store.journal_path != peer.journal_path
+    assert os.path.exists(store.journal_path)
+    with open(store.journal_path, "a") as f, pytest.raises(BlockingIOError):
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_replace_batch_replays(tmp_path):
+    doc = str(tmp_path / "sally.json")
+    write_journal(tmp_path / "journal.log",
+                  json.dumps({"ops": [[doc, "set", ["old", 1]], [doc, "replace", [{"new": 2}]]]}))
+
+    WriteBehindStore().open(str(tmp_path))
+
+    assert load(doc) == {"new": 2}
+
+
+def test_writes_are_visible_before_flush_and_on_disk_after(tmp_path):
+    doc = str(tmp_path / "user.json")
+    store = WriteBehindStore()
+    store.open(str(tmp_path))
+
+    store.set(doc, "a", 1)
+    assert store.read(doc) == {"a": 1}
+    assert not os.path.exists(doc)
+
+    asyncio.run(store.flush())
+    assert load(doc) == {"a": 1}
+    assert os.path.getsize(tmp_path / "journal.log") == 0
+    assert store.get_metrics()["pending_writes"] == 0
+
+
+def test_shared_flush_merges_other_workers_writes(tmp_path):
+    doc = str(tmp_path / "usage.json")
+    first, second = WriteBehindStore(shared=True), WriteBehindStore(shared=True)
+    first.open(str(tmp_path))
+    second.open(str(tmp_path))
+    # Both have the document cached before either writes
+    first.read(doc)
+    second.read(doc)
+
+    first.set(doc, "a", 1)
+    first.set_field(doc, "session", "worker-1", {"tokens": 5})
+    second.set(doc, "b", 2)
+    second.set_field(doc, "session", "worker-2", {"tokens": 7})
+    asyncio.run(first.flush())
+    asyncio.run(second.flush())
+
+    expected = {"a": 1, "b": 2, "session": {"worker-1": {"tokens": 5}, "worker-2": {"tokens": 7}}}
+    assert load(doc) == expected
+    # The later committer caches what it wrote, other workers' writes included
+    assert second.read(doc) == expected
+    first.invalidate([doc])
+    assert first.read(doc) == expected
+
+
+def test_shared_flush_keeps_writes_made_during_the_commit(tmp_path):
+    doc = str(tmp_path / "user.json")
+    store = WriteBehindStore(shared=True)
+    store.open(str(tmp_path))
+    store.set(doc, "a", 1)
+
+    async def flush_while_writing():
+        flush = asyncio.create_task(store.flush())
+        await asyncio.sleep(0)
+        store.set(doc, "b", 2)
+        await flush
+
+    asyncio.run(flush_while_writing())
+    assert load(doc) == {"a": 1}
+    assert store.read(doc) == {"a": 1, "b": 2}
+
+    asyncio.run(store.flush())
+    assert load(doc) == {"a": 1, "b": 2}
+
+
+def test_invalidate_keeps_documents_with_pending_writes(tmp_path):
+    doc = str(tmp_path / "user.json")
+    store = WriteBehindStore(shared=True)
+    store.open(str(tmp_path))
+    store.set(doc, "a", 1)
+
+    store.invalidate([doc])
+
+    assert store.read(doc) == {"a": 1}
+
+
+def test_dirty_documents_are_not_evicted(tmp_path, cache_limit):
+    cache_limit(2)
+    paths = [str(tmp_path / f"{i}.json") for i in range(4)]
+    store = WriteBehindStore()
+    store.open(str(tmp_path))
+
+    for i, path in enumerate(paths):
+        store.set(path, "value", i)
+    assert store.get_metrics()["cached_documents"] == 4
+
+    asyncio.run(store.flush())
+    metrics = store.get_metrics()
+    assert metrics["cached_documents"] == 2
+    assert metrics["cache_evictions"] == 2
+    # Evicted documents come back from disk
+    assert [store.read(path) for path in paths] == [{"value": i} for i in range(4)]
+
+
+def test_clean_documents_are_evicted_least_recently_used_first(tmp_path, cache_limit):
+    cache_limit(2)
+    paths = [str(tmp_path / f"{i}.json") for i in range(3)]
+    for i, path in enumerate(paths):
+        with open(path, "w") as f:
+            json.dump({"value": i}, f)
+    store = WriteBehindStore()
+    store.open(str(tmp_path))
+
+    store.read(paths[0])
+    store.read(paths[1])
+    store.read(paths[0])
+    store.read(paths[2])
+
+    assert set(store.documents()) == {paths[0], paths[2]}
+
+
+def test_documents_that_cannot_be_saved_stay_cached(tmp_path, cache_limit):
+    cache_limit(1)
+    unsavable = str(tmp_path / "missing" / "user.json")
+    store = WriteBehindStore()
+    store.open(str(tmp_path))
+    store.set(unsavable, "a", 1)
+    asyncio.run(store.flush())
+
+    for i in range(3):
+        store.read(str(tmp_path / f"{i}.json"))
+
+    assert store.read(unsavable) == {"a": 1}
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+from storage import WriteBehindStore
+from usage import UsageTracker
+
+TURN = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+
+
+def start_worker(directory):
+    store = WriteBehindStore(shared=True)
+    store.open(str(directory))
+    tracker = UsageTracker(store)
+    tracker.open(os.path.join(str(directory), "usage.json"))
+    return store, tracker
+
+
+def take_turn(worker, session="s1"):
+    store, tracker = worker
+    tracker.record(session, "chat", "model", TURN)
+    tracker.flush()
+    asyncio.run(store.flush())
+
+
+def calls_by_worker(directory, session="s1"):
+    with open(os.path.join(str(directory), "usage.json")) as f:
+        entry = json.load(f)[session]
+    return {worker: counts["calls"]["chat"]["model"]["calls"] for worker, counts in entry.items()}
+
+
+def test_workers_keep_their_own_counts(tmp_path):
+    first, second = start_worker(tmp_path), start_worker(tmp_path)
+    # Both cache the document before either commits
+    first[0].read(first[1].path)
+    second[0].read(second[1].path)
+
+    take_turn(first)
+    take_turn(second)
+    take_turn(first)
+
+    assert calls_by_worker(tmp_path) == {"worker-0": 2, "worker-1": 1}
+
+
+def test_restarted_worker_reuses_a_free_slot(tmp_path):
+    first, second = start_worker(tmp_path), start_worker(tmp_path)
+    take_turn(first)
+    take_turn(second)
+
+    # The first worker exits and a new one takes its place
+    first[1]._slot_lock.close()
+    replacement = start_worker(tmp_path)
+    take_turn(replacement)
+
+    assert replacement[1].worker == "worker-0"
+    assert calls_by_worker(tmp_path) == {"worker-0": 2, "worker-1": 1}
+
+
+def test_window_resumes_from_every_worker(tmp_path):
+    first, second = start_worker(tmp_path), start_worker(tmp_path)
+    take_turn(first)
+    take_turn(second)
+
+    _, third = start_worker(tmp_path)
+    window = third._window("s1")
+
+    assert (window.tokens, window.others) == (30, 30)
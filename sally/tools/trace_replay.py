@@ -0,0 +1,295 @@
+"""Capture-and-replay harness for Sally's /chat traffic.
+
+Build a trace from existing memory files, or use one recorded by the app
+with TRACE_CAPTURE_FILE, then replay it in-process against the real app
+with a fake model backend:
+
+    python tools/trace_replay.py reconstruct --memory-dir app/memory -o trace.jsonl
+    python tools/trace_replay.py replay trace.jsonl --speed 10 --max-gap 2
+
+The replay reports prompt sizes, per-stage latency, storage growth and
+resident memory per session, so regressions in prompt assembly,
+persistence or memory footprint show up before deploying.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, APP_DIR)
+
+# 1x1 transparent PNG returned by the fake image model
+FAKE_PNG_B64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADElEQVR4nGNgYGAAAAAEAAH2FzhVAAAAAElFTkSuQmCC"
+
+# How chat.py records a /change in the character's memory
+CHANGE_PREFIX = "Character personality was changed to: "
+
+VOCABULARY = ("hey", "so", "work", "was", "kind", "of", "long", "today", "but", "the", "concert",
+              "tonight", "should", "be", "fun", "what", "are", "you", "up", "to", "lol", "honestly")
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/max summary of a list of numbers"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {"count": len(ordered), "p50": round(pick(0.5), 2), "p95": round(pick(0.95), 2), "max": round(ordered[-1], 2)}
+
+
+def directory_size(path: str) -> int:
+    """Total bytes of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def session_memory(store) -> Dict[str, Any]:
+    """Resident size of each session's cached memory, compared with plain dicts"""
+    from memory_records import MemoryLog
+
+    compact: Dict[str, int] = defaultdict(int)
+    plain: Dict[str, int] = defaultdict(int)
+    for path, document in store.documents().items():
+        if not isinstance(document, MemoryLog):
+            continue
+        session = os.path.dirname(path)
+        compact[session] += document.nbytes()
+        items = document.to_dict()
+        plain[session] += sys.getsizeof(items) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in items.items())
+    return {
+        "sessions": len(compact),
+        "bytes_per_session": percentiles(list(compact.values())),
+        "dict_bytes_per_session": percentiles(list(plain.values())),
+    }
+
+
+def reconstruct(memory_dir: str, output: str):
+    """Rebuild an anonymized trace from user.json/sally.json histories"""
+    from memory_stream import iter_memory_entries, USER_ROLE, CHARACTER_ROLE
+    from tracing import anonymize_session, describe_message
+    from memory_records import USER_TURN_PREFIX
+
+    sessions = {"default": memory_dir}
+    sessions_dir = os.path.join(memory_dir, "sessions")
+    if os.path.isdir(sessions_dir):
+        for name in os.listdir(sessions_dir):
+            sessions[name] = os.path.join(sessions_dir, name)
+
+    records = []
+    for session_id, directory in sessions.items():
+        entries = iter_memory_entries(os.path.join(directory, "user.json"), os.path.join(directory, "sally.json"))
+        for entry in entries:
+            content = entry["content"]
+            if not isinstance(content, str):
+                continue
+            if entry["role"] == USER_ROLE and content.startswith(USER_TURN_PREFIX):
+                message = content[len(USER_TURN_PREFIX):]
+            elif entry["role"] == CHARACTER_ROLE and content.startswith(CHANGE_PREFIX):
+                message = f"/change {content[len(CHANGE_PREFIX):]}"
+            else:
+                continue
+            try:
+                started = datetime.fromisoformat(entry["timestamp"].rstrip("Z")).timestamp()
+            except ValueError:
+                continue
+            records.append({"t": round(started, 3), "session": anonymize_session(session_id),
+                            **describe_message(message), "status": 200})
+
+    records.sort(key=lambda record: record["t"])
+    with open(output, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"Wrote {len(records)} records from {len(sessions)} session(s) to {output}")
+
+
+class FakeTogether:
+    """Stand-in for AsyncTogether with configurable latency that records every prompt"""
+
+    def __init__(self, latency_ms: float, ms_per_token: float, seed: int):
+        self.latency = latency_ms / 1000
+        self.per_token = ms_per_token / 1000
+        self.random = random.Random(seed)
+        self.prompts: List[Dict[str, Any]] = []
+        self.image_calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.images = SimpleNamespace(generate=self._image)
+
+    async def _chat(self, model: str, messages: List[Dict[str, str]], max_tokens: int = 100, **kwargs):
+        prompt_chars = sum(len(message["content"]) for message in messages)
+        self.prompts.append({"model": model, "chars": prompt_chars, "messages": len(messages), "max_tokens": max_tokens})
+
+        tokens = self.random.randint(max(1, max_tokens // 3), max_tokens)
+        await asyncio.sleep(self.latency + self.per_token * tokens)
+
+        if "create a simple, natural personality" in messages[0]["content"]:
+            content = "You're Alex — 27, replay test character. Keep replies short and casual."
+        else:
+            content = " ".join(self.random.choice(VOCABULARY) for _ in range(max(1, tokens * 3 // 4)))
+        usage = SimpleNamespace(prompt_tokens=prompt_chars // 4, completion_tokens=tokens,
+                                total_tokens=prompt_chars // 4 + tokens)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    async def _image(self, **kwargs):
+        self.image_calls += 1
+        await asyncio.sleep(self.latency * 2)
+        return SimpleNamespace(data=[SimpleNamespace(b64_json=FAKE_PNG_B64)])
+
+
+def synthesize_message(record: Dict[str, Any]) -> str:
+    """Filler text with the recorded message's shape"""
+    words = " ".join(VOCABULARY[i % len(VOCABULARY)] for i in range(max(1, record.get("message_words", 1))))
+    if record.get("kind") == "change":
+        return f"/change you're now Alex, {words}"
+    return words
+
+
+def prepare_workdir() -> str:
+    """Scratch working directory with the app's static files and empty memory"""
+    workdir = tempfile.mkdtemp(prefix="sally-replay-")
+    os.makedirs(os.path.join(workdir, "memory"))
+    os.makedirs(os.path.join(workdir, "static", "avatars"))
+    static_dir = os.path.join(APP_DIR, "static")
+    for name in os.listdir(static_dir):
+        source = os.path.join(static_dir, name)
+        if os.path.isfile(source):
+            os.symlink(source, os.path.join(workdir, "static", name))
+    return workdir
+
+
+async def replay(args):
+    """Replay a trace against the app with the fake backend and print a report"""
+    with open(args.trace) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("Trace is empty")
+        return
+
+    workdir = prepare_workdir()
+    os.chdir(workdir)
+    os.environ.setdefault("TOGETHER_API_KEY", "replay")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["SIMULATE_TYPING_DELAY"] = "0"
+
+    import httpx
+    import main
+
+    fake = FakeTogether(args.latency_ms, args.ms_per_token, args.seed)
+    main.chat_handler.client = fake
+    stages: Dict[str, List[float]] = defaultdict(list)
+    main.chat_handler.stage_observer = lambda stage, seconds: stages[stage].append(seconds * 1000)
+
+    tracemalloc.start()
+    await main.app.router.startup()
+    await main.chat_handler.store.flush()
+    storage_before = directory_size(os.path.join(workdir, "memory"))
+
+    # Trace time -> replay offsets, with idle gaps capped and the speed-up applied
+    offsets = []
+    offset = 0.0
+    for previous, record in zip([records[0]] + records, records):
+        gap = max(0.0, record["t"] - previous["t"])
+        if args.max_gap is not None:
+            gap = min(gap, args.max_gap)
+        offset += gap
+        offsets.append(offset / args.speed if args.speed > 0 else 0.0)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=main.app)
+    started = time.perf_counter()
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=None) as client:
+        async def send(record: Dict[str, Any], at: float):
+            nonlocal errors
+            await asyncio.sleep(max(0.0, started + at - time.perf_counter()))
+            async with semaphore:
+                request_started = time.perf_counter()
+                response = await client.post("/chat", json={"message": synthesize_message(record),
+                                                            "session_id": record.get("session")})
+                latencies[record.get("kind", "chat")].append((time.perf_counter() - request_started) * 1000)
+                if response.status_code != 200:
+                    errors += 1
+
+        await asyncio.gather(*(send(record, at) for record, at in zip(records, offsets)))
+
+    wall_seconds = time.perf_counter() - started
+    await main.chat_handler.store.flush()
+    storage_after = directory_size(os.path.join(workdir, "memory"))
+    traced_current, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await main.app.router.shutdown()
+
+    report = {
+        "requests": len(records),
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(len(records) / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {kind: percentiles(values) for kind, values in latencies.items()},
+        "stage_ms": {stage: percentiles(values) for stage, values in stages.items()},
+        "prompt_chars": percentiles([prompt["chars"] for prompt in fake.prompts]),
+        "prompt_messages": percentiles([prompt["messages"] for prompt in fake.prompts]),
+        "upstream_calls": {"chat": len(fake.prompts), "image": fake.image_calls},
+        "storage_bytes": {"before": storage_before, "after": storage_after, "growth": storage_after - storage_before},
+        "storage": main.chat_handler.store.get_metrics(),
+        "memory": session_memory(main.chat_handler.store),
+        "traced_memory": {"current": traced_current, "peak": traced_peak},
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.keep:
+        print(f"Replay working directory kept at {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reconstruct_parser = commands.add_parser("reconstruct", help="build a trace from memory files")
+    reconstruct_parser.add_argument("--memory-dir", default=os.path.join(APP_DIR, "memory"))
+    reconstruct_parser.add_argument("-o", "--output", default="trace.jsonl")
+
+    replay_parser = commands.add_parser("replay", help="replay a trace against the app with a fake model backend")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor; 0 sends everything at once")
+    replay_parser.add_argument("--max-gap", type=float, default=None, help="cap idle gaps between records (seconds of trace time)")
+    replay_parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    replay_parser.add_argument("--limit", type=int, default=0, help="only replay the first N records")
+    replay_parser.add_argument("--latency-ms", type=float, default=300, help="fake model base latency")
+    replay_parser.add_argument("--ms-per-token", type=float, default=15, help="fake model per-token latency")
+    replay_parser.add_argument("--seed", type=int, default=0)
+    replay_parser.add_argument("--keep", action="store_true", help="keep the scratch working directory")
+
+    args = parser.parse_args()
+    if args.command == "reconstruct":
+        reconstruct(os.path.abspath(args.memory_dir), args.output)
+    else:
+        asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()